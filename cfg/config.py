@@ -68,6 +68,10 @@ PARA_R = {
     'formatDate'    : 2,
     'keepUpToDate'  : True
 }
+STORAGE_COMPACT = {    # Opt-in, trades float64 precision for memory.
+    'fields': ['open', 'high', 'low', 'close'],     # MIDPOINT bars carry no volume.
+    'dtype' : 'float32',
+}
 MARKET_DATA = {
     'EUR.USD':
         {
@@ -79,6 +83,7 @@ MARKET_DATA = {
             'update_func': None,
             'df_base'    : None,
             'max_len'    : 100000,
+            'storage'    : None,    # All fields in float64, STORAGE_COMPACT keeps OHLC only in float32.
          },
     'GBP.USD':
         {
@@ -90,9 +95,11 @@ MARKET_DATA = {
             'update_func': None,
             'df_base'    : None,
             'max_len'    : 100000,
+            'storage'    : None,    # All fields in float64, STORAGE_COMPACT keeps OHLC only in float32.
         }
 }
 FX_PAIRS_FILE = r'C:\Users\USER\PycharmProjects\Forge\statics\FX_Symbols.csv'
+BAR_CACHE_DIR = None    # Directory of the bar cache, e.g. r'C:\Users\USER\PycharmProjects\Forge\cache\bars'. None to disable.
 SHADOW_DATA = {
     'EUR.USD_CFD':
         {
@@ -105,10 +112,46 @@ SHADOW_DATA = {
             'market_data_id': 'GBP.USD'
         },
 }
+RESAMPLED_DATA = {
+    # 'EUR.USD_5M':
+    #     {
+    #         'market_data_id': 'EUR.USD',
+    #         'bar_size'      : '5 mins',
+    #         'max_len'       : 20000,
+    #     },
+    # 'EUR.USD_1H':
+    #     {
+    #         'market_data_id': 'EUR.USD',
+    #         'bar_size'      : '1 hour',
+    #         'max_len'       : 5000,
+    #     },
+}
+TICK_BAR_DATA = {
+    # 'EUR.USD_5S':
+    #     {
+    #         'contract_id': 'EUR.USD',
+    #         'bar_size'   : '5 secs',
+    #         'max_len'    : 20000,
+    #     },
+}
+PANEL_DATA = None
+# PANEL_DATA = {
+#     'market_data_ids': list(MARKET_DATA.keys()),
+#     'fields'         : ['open', 'high', 'low', 'close'],
+#     'max_len'        : 20000,
+# }
 CONFIG_MARKET_DATA = {
-    'MARKET_DATA'  : MARKET_DATA,
-    'SHADOW_DATA'  : SHADOW_DATA,
-    'FX_PAIRS_FILE': FX_PAIRS_FILE,
+    'MARKET_DATA'            : MARKET_DATA,
+    'SHADOW_DATA'            : SHADOW_DATA,
+    'RESAMPLED_DATA'         : RESAMPLED_DATA,
+    'TICK_BAR_DATA'          : TICK_BAR_DATA,
+    'PANEL_DATA'             : PANEL_DATA,     # None to disable.
+    'FX_PAIRS_FILE'          : FX_PAIRS_FILE,
+    'BAR_CACHE_DIR'          : BAR_CACHE_DIR,
+    'MAX_CONCURRENT_REQUESTS': 10,
+    'FX_READY_TIMEOUT'       : 30,      # Seconds
+    'GAP_MAX_DURATION'       : '2 hours',   # Longer breaks are treated as session closes, None to disable.
+    'RAW_BARS_MAX_LEN'       : 100,     # Raw ib_insync bars kept per series after ingestion, None to keep all.
 }
 
 # --------------------------- Config - Event Manager -----------------------------
@@ -143,12 +186,26 @@ CONFIG_EVENT = {
     'SWITCH': EVENT_SWITCH
 }
 
+# --------------------------- Config - Request Manager -----------------------------
+
+CONFIG_REQUEST = {
+    'HIST_MAX_REQUESTS'      : 60,      # Historical data requests per pacing window.
+    'HIST_PACING_WINDOW'     : 600,     # Seconds
+    'HIST_MAX_CONCURRENT'    : 50,
+    'HIST_IDENTICAL_COOLDOWN': 15,      # Seconds
+    'MSG_MAX_RATE'           : 40,      # Market data and contract requests per second.
+}
+
 # --------------------------- Config - Portfolio -----------------------------
 
 CONFIG_PORTFOLIO = {
     'VALUE_BASIS': 'net_liq'
 }
 
+# --------------------------- Config - Indicator -----------------------------
+
+CONFIG_INDICATOR = None
+
 # --------------------------- Config - Signal -----------------------------
 
 CONFIG_SIGNAL = None
@@ -173,6 +230,7 @@ CONFIG_ATR_TRAILING_1 = {
     'SIGNAL_VALID_LATENCY' : PARA_R['barSizeSetting'],
     'SIGNAL_VALID_SURVIVAL': '1 day',
     'SEND_INITIAL_SIGNAL'  : True,
+    'HISTORY_LEN'          : 1000,      # Bars of levels kept for plotting.
 }
 CONFIG_ATR_TRAILING_2 = {
     'STRATEGY_ID'          : 'ATRTrailing2',
@@ -185,7 +243,25 @@ CONFIG_ATR_TRAILING_2 = {
     'SIGNAL_VALID_LATENCY' : PARA_R['barSizeSetting'],
     'SIGNAL_VALID_SURVIVAL': '1 day',
     'SEND_INITIAL_SIGNAL'  : False,
+    'HISTORY_LEN'          : 1000,      # Bars of levels kept for plotting.
 }
+
+# --------------------------- Config - ATRTrailing Universe -----------------------------
+
+CONFIG_ATR_TRAILING_UNIVERSE = {
+    'STRATEGY_ID'          : 'ATRTrailingUniverse1',
+    'CONTRACT_IDS'         : ['EUR.USD_CFD', 'GBP.USD_CFD'],
+    'MARKET_DATA_IDS'      : ['EUR.USD_CFD', 'GBP.USD_CFD'],     # In the order of CONTRACT_IDS.
+    'TAG'                  : 'EW1',
+    'WINDOW'               : 14,
+    'MULTIPLIER'           : 3,
+    'RANGE_TYPE'           : 'full',    # full or None
+    'SIGNAL_VALID_LATENCY' : PARA_R['barSizeSetting'],
+    'SIGNAL_VALID_SURVIVAL': '1 day',
+    'SEND_INITIAL_SIGNAL'  : False,
+    'PANEL_MAX_LEN'        : 2000,      # Bars the panel keeps at least for this strategy.
+}
+
 # --------------------------- Config - EqualWeight Allocator -----------------------------
 
 CONTRACT_SCOPE_ID = ['EUR.USD_CFD', 'GBP.USD_CFD']
@@ -198,6 +274,20 @@ CONFIG_EQUAL_WEIGHT = {
     'MIN_WEIGHT_DIFF': 0.02,
 }
 
+# --------------------------- Config - Backtest -----------------------------
+
+CONFIG_BACKTEST = {
+    'START_TIME'  : '2023-01-02 00:00:00',     # UTC, bars before it serve the initial history.
+    'END_TIME'    : '2023-12-29 00:00:00',     # UTC
+    'BAR_FILES'   : None,     # Symbol to csv or parquet of date, open, high, low, close, required to backtest, e.g.
+                              # {'EUR.USD': r'C:\Users\USER\PycharmProjects\Forge\data\EUR.USD_1min.csv',
+                              #  'GBP.USD': r'C:\Users\USER\PycharmProjects\Forge\data\GBP.USD_1min.csv'}
+    'BASE_CCY'    : CONFIG_AGENT['BASE_CCY'],
+    'INITIAL_CASH': 1000000,
+    'COMMISSION'  : 0.00002,    # Fraction of traded notional.
+}
+MARKET_DATA_BACKTEST = {id_: dict(val, para=PARA_H, option=1) for id_, val in MARKET_DATA.items()}
+
 # --------------------------- Config - Master -----------------------------
 
 CONFIG_LOGGING = {
@@ -257,8 +347,10 @@ CONFIG_MASTER = {
     'AGENT'      : CONFIG_AGENT,
     'ACCOUNT'    : CONFIG_ACCOUNT,
     'EVENT'      : CONFIG_EVENT,
+    'REQUEST'    : CONFIG_REQUEST,
     'CONTRACT'   : CONFIG_CONTRACT,
     'MARKET_DATA': CONFIG_MARKET_DATA,
+    'INDICATOR'  : CONFIG_INDICATOR,
     'PORTFOLIO'  : CONFIG_PORTFOLIO,
     'SIGNAL'     : CONFIG_SIGNAL,
     'TRADE'      : CONFIG_TRADE,
@@ -268,5 +360,11 @@ CONFIG_MASTER = {
     'ATR_TRAILING_1': CONFIG_ATR_TRAILING_1,
     'ATR_TRAILING_2': CONFIG_ATR_TRAILING_2,
 
+    'ATR_TRAILING_UNIVERSE': CONFIG_ATR_TRAILING_UNIVERSE,
+
     'EQUAL_WEIGHT'  : CONFIG_EQUAL_WEIGHT,
 }
+CONFIG_MASTER_BACKTEST = dict(CONFIG_MASTER,
+                              AGENT=dict(CONFIG_AGENT, MODE='backtest'),
+                              MARKET_DATA=dict(CONFIG_MARKET_DATA, MARKET_DATA=MARKET_DATA_BACKTEST, TICK_BAR_DATA={}, BAR_CACHE_DIR=None),
+                              BACKTEST=CONFIG_BACKTEST)
@@ -0,0 +1,13 @@
+from example.run_trading import Agent1
+from src.manager.Backtest import SimulatedBroker
+from cfg.config import *
+
+
+if __name__ == '__main__':
+
+    ib = SimulatedBroker(CONFIG_MASTER_BACKTEST['BACKTEST'])
+    A1 = Agent1(ib)
+    A1.run(CONFIG_MASTER_BACKTEST)
+
+    print(ib.getEquityDf())
+    print(ib.getFillsDf())
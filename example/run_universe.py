@@ -0,0 +1,47 @@
+import ib_insync as ibi
+from src.manager.Agent import Agent
+from src.strategy import ATRTrailingUniverse
+from src.allocator import EqualWeight
+from src.util.log_util import *
+from cfg.config import *
+
+updateLogFilePath()
+logging.config.dictConfig(CONFIG_LOGGING)
+
+
+class Agent2(Agent):
+
+    # Same contracts as Agent1 in run_trading, traded by one ATRTrailingUniverse instead of one ATRTrailing per
+    # contract. Signals are keyed under the universe strategy ID.
+
+    @Logger('main', 'info')
+    def __init__(self, ib):
+        super().__init__(ib)
+        self.atrTrailingUniverse1 = ATRTrailingUniverse.ATRTrailingUniverse(agent=self)
+        self.ew1 = EqualWeight.EqualWeight(agent=self)
+
+    @Logger('main', 'info')
+    def initialize(self, config):
+        super().startInitialize(config)
+
+        self.atrTrailingUniverse1.initialize(config['ATR_TRAILING_UNIVERSE'])
+        self.ew1.initialize(config['EQUAL_WEIGHT'])
+
+        super().endInitialize()
+
+    @Logger('main', 'info')
+    def update(self):
+        super().startUpdate()
+
+        print('run update')
+        self.atrTrailingUniverse1.update()
+        self.ew1.update()
+
+        super().endUpdate()
+
+
+if __name__ == '__main__':
+
+    ib = ibi.IB()
+    A2 = Agent2(ib)
+    A2.run(CONFIG_MASTER)
@@ -59,12 +59,10 @@ class PortfolioAllocatorBySignal(object):
     @Logger('main', 'debug')
     def checkContractStatus(self, contract):
         # Check if data is active.
-        activeStatusDf = self.agent.MarketDataManager.activeStatusData.getDf('contract', contract)
-        isActive       = activeStatusDf['status'].iloc[activeStatusDf['update_time'].argmax()]
+        isActive  = self.agent.MarketDataManager.activeStatusData.getStatusByConId(contract.conId)
 
         # Check if bar data is updated.
-        updateStatusDf = self.agent.MarketDataManager.updateStatusData.getDf('contract', contract)
-        isUpdated      = updateStatusDf['status'].iloc[updateStatusDf['update_time'].argmax()]
+        isUpdated = self.agent.MarketDataManager.updateStatusData.getStatusByConId(contract.conId)
 
         return isActive and isUpdated
 
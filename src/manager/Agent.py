@@ -1,10 +1,12 @@
 from src.manager.Contract import ContractManager
 from src.manager.MarketData import MarketDataManager
+from src.manager.Indicator import IndicatorManager
 from src.manager.Event import EventManager
 from src.manager.Portfolio import PortfolioManager
 from src.manager.Account import AccountManager
 from src.manager.Signal import SignalManager
 from src.manager.Trade import TradeManager
+from src.manager.Request import RequestManager
 from src.util.log_util import *
 
 
@@ -31,8 +33,10 @@ class Agent(object):
 
         self.AccountManager    = AccountManager(agent=self)
         self.EventManager      = EventManager(agent=self)
+        self.RequestManager    = RequestManager(agent=self)
         self.ContractManager   = ContractManager(agent=self)
         self.MarketDataManager = MarketDataManager(agent=self)
+        self.IndicatorManager  = IndicatorManager(agent=self)
         self.PortfolioManager  = PortfolioManager(agent=self)
         self.SignalManager     = SignalManager(agent=self)
         self.TradeManager      = TradeManager(agent=self)
@@ -51,7 +55,7 @@ class Agent(object):
     @Logger('main', 'debug')
     def checkStreaming(self):
         if (self.EventManager.isRequestRequired is True) and (self.EventManager.isIbConnected is True):
-            self.MarketDataManager.resetAllData()
+            self.MarketDataManager.resubscribeAllData()
             self.EventManager.isRequestRequired = False
             return True
         elif (self.EventManager.isRequestRequired is True) and (self.EventManager.isIbConnected is False):
@@ -107,6 +111,11 @@ class Agent(object):
 
     @Logger('main', 'debug')
     def getLoopingTimePara(self):
+        if self.mode == 'backtest':
+            self.startTime = self.ib.startTime.to_pydatetime()
+            self.endTime   = self.ib.endTime.to_pydatetime()
+            return
+
         now = datetime.datetime.now()
         date = now.date()
         hour = now.hour
@@ -152,8 +161,10 @@ class Agent(object):
 
         self.AccountManager.initialize(config['ACCOUNT'])
         self.EventManager.initialize(config['EVENT'])
+        self.RequestManager.initialize(config['REQUEST'])
         self.ContractManager.initialize(config['CONTRACT'])
         self.MarketDataManager.initialize(config['MARKET_DATA'])
+        self.IndicatorManager.initialize(config['INDICATOR'])
         self.PortfolioManager.initialize(config['PORTFOLIO'])
         self.SignalManager.initialize(config['SIGNAL'])
         self.TradeManager.initialize(config['TRADE'])
@@ -186,8 +197,10 @@ class Agent(object):
 
         self.AccountManager.update()
         self.EventManager.update()
+        self.RequestManager.update()
         self.ContractManager.update()
         self.MarketDataManager.update()
+        self.IndicatorManager.update()
         self.PortfolioManager.update()
 
     # ------------------------------------- Routine Checks -------------------------------------
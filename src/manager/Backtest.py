@@ -0,0 +1,520 @@
+import itertools
+import numpy as np
+import pandas as pd
+import ib_insync as ibi
+from src.util.dt_util import mapBarSize
+from src.util.log_util import *
+
+
+class SimulatedBroker(object):
+
+    # Stand-in for ib_insync.IB that replays stored bars on a simulated clock. The clock only moves through
+    # timeRange, sleep and waitOnUpdate, so nothing waits in real time. The bar open at the clock is served flat at
+    # its open price, market orders fill at the open of the next bar and limit orders once a completed bar trades
+    # through them. Prices are taken to be quoted in the base currency.
+
+    events = ('errorEvent', 'connectedEvent', 'disconnectedEvent', 'updateEvent', 'pendingTickersEvent',
+              'barUpdateEvent', 'newOrderEvent', 'orderModifyEvent', 'cancelOrderEvent', 'openOrderEvent',
+              'orderStatusEvent', 'execDetailsEvent', 'commissionReportEvent', 'updatePortfolioEvent',
+              'positionEvent', 'accountValueEvent', 'accountSummaryEvent', 'pnlEvent', 'pnlSingleEvent',
+              'tickNewsEvent', 'newsBulletinEvent', 'scannerDataEvent', 'timeoutEvent')
+
+    durationUnits = {'S': 1, 'D': 86400, 'W': 7 * 86400, 'M': 30 * 86400, 'Y': 365 * 86400}
+
+    @Logger('main', 'info')
+    def __init__(self, config):
+        for event in self.events:
+            setattr(self, event, ibi.Event(event))
+
+        self.config       = config
+        self.account      = config.get('ACCOUNT', 'SIM')
+        self.baseCcy      = config['BASE_CCY']
+        self.commission   = config['COMMISSION']     # Fraction of traded notional.
+        self.startTime    = pd.Timestamp(config['START_TIME'], tz='UTC')
+        self.endTime      = pd.Timestamp(config['END_TIME'], tz='UTC')
+        self.clock        = self.startTime
+        self.cash         = float(config['INITIAL_CASH'])
+        self.realizedPnl  = 0.
+        self.connected    = False
+        self.series       = dict()     # Symbol to bar dates in epoch ns, values and bar size in ns.
+        self.conIds       = dict()     # (secType, symbol) to simulated conId.
+        self.positionDict = dict()     # conId to [contract, position, average cost].
+        self.tickers      = dict()     # conId to ticker.
+        self.tradeList    = list()
+        self.fillList     = list()
+        self.equity       = list()     # (clock, net liquidation) per step.
+        self.orderIds     = itertools.count(1)
+        self.execIds      = itertools.count(1)
+
+        if not config.get('BAR_FILES'):
+            raise ValueError(f'Error:Backtest:{self.__class__.__name__}:{inspect.currentframe().f_code.co_name} '
+                             f'- BAR_FILES is not set in the backtest config.')
+        for symbol, filePath in config['BAR_FILES'].items():
+            self.loadBars(symbol, self.readBars(filePath))
+
+    # ------------------------------------- Basic Functions -------------------------------------
+
+    @staticmethod
+    def readBars(filePath):
+        df = pd.read_parquet(filePath) if filePath.endswith('.parquet') else pd.read_csv(filePath)
+        df['date'] = pd.to_datetime(df['date'], utc=True)
+        return df
+
+    @Logger('main', 'info')
+    def loadBars(self, symbol, df):
+        # Bars by localSymbol, e.g. 'EUR.USD' for both the Forex pair and its CFD.
+        df    = df.sort_values('date')
+        dates = pd.to_datetime(df['date'], utc=True).values.astype('datetime64[ns]').astype('int64')
+        self.series[symbol] = {
+            'dates' : dates,
+            'values': np.vstack([df[field].to_numpy(dtype='float64') for field in ['open', 'high', 'low', 'close']]),
+            'sizeNs': int(np.median(np.diff(dates))) if len(dates) > 1 else 0,
+        }
+
+    @staticmethod
+    def getSymbol(contract):
+        return contract.localSymbol if contract.localSymbol else f'{contract.symbol}.{contract.currency}'
+
+    @staticmethod
+    def toTimestamp(date):
+        date = pd.Timestamp(date)
+        return date.tz_localize('UTC') if date.tzinfo is None else date.tz_convert('UTC')
+
+    @staticmethod
+    def toDatetime(dateNs):
+        return pd.Timestamp(int(dateNs), tz='UTC').to_pydatetime()
+
+    def getDurationNs(self, durationStr):
+        num, unit = durationStr.split()
+        return int(num) * self.durationUnits[unit] * 10 ** 9
+
+    def getBar(self, series, i):
+        # The bar still open at the clock only shows its open price, as it would live.
+        dateNs = series['dates'][i]
+        o, h, l, c = series['values'][:, i].tolist()
+        if dateNs + series['sizeNs'] > self.clock.value:
+            h = l = c = o
+        return ibi.BarData(date=self.toDatetime(dateNs), open=o, high=h, low=l, close=c, volume=-1, average=-1, barCount=-1)
+
+    def getPrice(self, symbol):
+        series = self.series.get(symbol)
+        if series is None:
+            return np.nan
+        i = int(np.searchsorted(series['dates'], self.clock.value, 'right')) - 1
+        if i < 0:
+            return np.nan
+        return self.getBar(series, i).close
+
+    # ------------------------------------- Connection -------------------------------------
+
+    @Logger('main', 'info')
+    def connect(self, host='127.0.0.1', port=7497, clientId=1, *args, **kwargs):
+        self.connected = True
+        self.connectedEvent.emit()
+        return self
+
+    @Logger('main', 'info')
+    def disconnect(self):
+        self.connected = False
+        self.disconnectedEvent.emit()
+
+    def isConnected(self):
+        return self.connected
+
+    def managedAccounts(self):
+        return [self.account]
+
+    # ------------------------------------- Clock -------------------------------------
+
+    def reqCurrentTime(self):
+        return self.clock.to_pydatetime()
+
+    def timeRange(self, start, end, step):
+        # Same grid as ib_insync, past steps are skipped and the clock jumps to each step instead of waiting.
+        delta = pd.Timedelta(seconds=step)
+        t     = self.toTimestamp(start)
+        while t < self.clock:
+            t += delta
+        while t <= self.toTimestamp(end):
+            self.advance(t)
+            yield t.to_pydatetime()
+            t += delta
+
+    def sleep(self, secs=0.02):
+        self.advance(self.clock + pd.Timedelta(seconds=secs))
+        return True
+
+    def waitOnUpdate(self, timeout=0):
+        self.advance(self.clock + pd.Timedelta(seconds=timeout))
+        return True
+
+    # @Logger('main', 'debug')
+    def advance(self, t):
+        if t <= self.clock:
+            return
+        self.clock = t
+        self.updateOrders()
+        self.updateTickers()
+        self.equity.append((t, self.getNetLiq()))
+        self.updateEvent.emit()
+
+    # ------------------------------------- Contracts -------------------------------------
+
+    @Logger('main', 'debug')
+    async def qualifyContractsAsync(self, *contracts):
+        for contract in contracts:
+            symbol = self.getSymbol(contract)
+            key    = (contract.secType, symbol)
+            if key not in self.conIds:
+                self.conIds[key] = len(self.conIds) + 1
+            contract.conId       = self.conIds[key]
+            contract.localSymbol = symbol
+        return list(contracts)
+
+    def qualifyContracts(self, *contracts):
+        return ibi.util.run(self.qualifyContractsAsync(*contracts))
+
+    @Logger('main', 'debug')
+    async def reqContractDetailsAsync(self, contract):
+        return [ibi.ContractDetails(contract=contract)]
+
+    # ------------------------------------- Market Data -------------------------------------
+
+    @Logger('main', 'debug')
+    async def reqHistoricalDataAsync(self, contract, endDateTime, durationStr, barSizeSetting, whatToShow, useRTH,
+                                     formatDate=1, keepUpToDate=False, chartOptions=[], timeout=60):
+        if keepUpToDate:
+            raise ValueError(f'Error:Backtest:{self.__class__.__name__}:{inspect.currentframe().f_code.co_name} '
+                             f'- Streaming bars are not simulated, request historical bars instead.')
+
+        bars = ibi.BarDataList()
+        bars.reqId          = 0
+        bars.contract       = contract
+        bars.endDateTime    = endDateTime
+        bars.durationStr    = durationStr
+        bars.barSizeSetting = barSizeSetting
+        bars.whatToShow     = whatToShow
+        bars.useRTH         = useRTH
+        bars.formatDate     = formatDate
+        bars.keepUpToDate   = keepUpToDate
+        bars.chartOptions   = chartOptions
+
+        series = self.series.get(self.getSymbol(contract))
+        if series is None:
+            mainLogger.warning(f'No stored bars for {self.getSymbol(contract)}')
+            return bars
+
+        sizeNs = pd.Timedelta(mapBarSize(barSizeSetting)).value
+        if sizeNs != series['sizeNs']:
+            raise ValueError(f'Error:Backtest:{self.__class__.__name__}:{inspect.currentframe().f_code.co_name} '
+                             f'- Stored bars for {self.getSymbol(contract)} are not {barSizeSetting} bars.')
+
+        # An empty end is the clock and includes the open bar, an explicit end only the bars before it.
+        if endDateTime in ('', None):
+            endNs = self.clock.value
+            i1    = int(np.searchsorted(series['dates'], endNs, 'right'))
+        else:
+            endNs = min(pd.Timestamp(endDateTime).value, self.clock.value)
+            i1    = int(np.searchsorted(series['dates'], endNs, 'left'))
+        i0 = int(np.searchsorted(series['dates'], endNs - self.getDurationNs(durationStr), 'left'))
+
+        bars.extend(self.getBar(series, i) for i in range(i0, i1))
+        return bars
+
+    def reqHistoricalData(self, contract, *args, **kwargs):
+        return ibi.util.run(self.reqHistoricalDataAsync(contract, *args, **kwargs))
+
+    def cancelHistoricalData(self, bars):
+        pass
+
+    @Logger('main', 'debug')
+    def reqMktData(self, contract, genericTickList='', snapshot=False, regulatorySnapshot=False, mktDataOptions=None):
+        if contract.conId not in self.tickers:
+            self.tickers[contract.conId] = ibi.Ticker(contract=contract)
+            self.updateTicker(self.tickers[contract.conId])
+        return self.tickers[contract.conId]
+
+    @Logger('main', 'debug')
+    def cancelMktData(self, contract):
+        self.tickers.pop(contract.conId, None)
+
+    def updateTicker(self, ticker):
+        price = self.getPrice(self.getSymbol(ticker.contract))
+        ticker.time = self.clock.to_pydatetime()
+        ticker.bid  = price
+        ticker.ask  = price
+        ticker.last = price
+
+    # @Logger('main', 'debug')
+    def updateTickers(self):
+        for ticker in self.tickers.values():
+            self.updateTicker(ticker)
+        if len(self.tickers) > 0:
+            self.pendingTickersEvent.emit(set(self.tickers.values()))
+
+    # ------------------------------------- Orders -------------------------------------
+
+    @Logger('main', 'debug')
+    def placeOrder(self, contract, order):
+        if order.orderId == 0:
+            order.orderId = next(self.orderIds)
+        order.account = self.account
+        now   = self.clock.to_pydatetime()
+        trade = ibi.Trade(contract=contract, order=order,
+                          orderStatus=ibi.OrderStatus(orderId=order.orderId, status='Submitted',
+                                                      remaining=order.totalQuantity))
+        trade.log.append(ibi.TradeLogEntry(now, 'Submitted', ''))
+        self.tradeList.append(trade)
+        self.newOrderEvent.emit(trade)
+        self.openOrderEvent.emit(trade)
+        self.orderStatusEvent.emit(trade)
+        return trade
+
+    @Logger('main', 'debug')
+    def cancelOrder(self, order, manualCancelOrderTime=''):
+        for trade in self.openTrades():
+            if trade.order.orderId == order.orderId:
+                trade.orderStatus.status = 'Cancelled'
+                trade.log.append(ibi.TradeLogEntry(self.clock.to_pydatetime(), 'Cancelled', ''))
+                self.cancelOrderEvent.emit(trade)
+                self.orderStatusEvent.emit(trade)
+                return trade
+
+    def reqGlobalCancel(self):
+        for trade in self.openTrades():
+            self.cancelOrder(trade.order)
+
+    def trades(self):
+        return list(self.tradeList)
+
+    def openTrades(self):
+        return [trade for trade in self.tradeList if not trade.isDone()]
+
+    def orders(self):
+        return [trade.order for trade in self.tradeList]
+
+    def openOrders(self):
+        return [trade.order for trade in self.openTrades()]
+
+    def reqAllOpenOrders(self):
+        return self.openOrders()
+
+    def reqOpenOrders(self):
+        return self.openOrders()
+
+    def fills(self):
+        return list(self.fillList)
+
+    def executions(self):
+        return [fill.execution for fill in self.fillList]
+
+    # @Logger('main', 'debug')
+    def updateOrders(self):
+        for trade in self.openTrades():
+            price = self.getFillPrice(trade)
+            if not np.isnan(price):
+                self.fill(trade, price)
+
+    def getFillPrice(self, trade):
+        # First bar opened after the order was placed, limit orders wait for a completed bar trading through.
+        series = self.series.get(self.getSymbol(trade.contract))
+        if series is None:
+            return np.nan
+        i = int(np.searchsorted(series['dates'], pd.Timestamp(trade.log[0].time).value, 'right'))
+        if (i >= len(series['dates'])) or (series['dates'][i] > self.clock.value):
+            return np.nan
+
+        o, h, l, c = series['values'][:, i].tolist()
+        isBuy = trade.order.action == 'BUY'
+        if trade.order.orderType == 'MKT':
+            return o
+        if trade.order.orderType == 'LMT':
+            lmt = trade.order.lmtPrice
+            for j in range(i, int(np.searchsorted(series['dates'], self.clock.value - series['sizeNs'], 'right'))):
+                o, h, l, c = series['values'][:, j].tolist()
+                if isBuy and (l <= lmt):
+                    return min(o, lmt)
+                if (not isBuy) and (h >= lmt):
+                    return max(o, lmt)
+            return np.nan
+        raise ValueError(f'Error:Backtest:{self.__class__.__name__}:{inspect.currentframe().f_code.co_name} '
+                         f'- Order type {trade.order.orderType} is not simulated.')
+
+    @Logger('main', 'debug')
+    def fill(self, trade, price):
+        now        = self.clock.to_pydatetime()
+        quantity   = trade.order.totalQuantity
+        sign       = 1 if trade.order.action == 'BUY' else -1
+        commission = abs(quantity * price) * self.commission
+        realized   = self.updatePosition(trade.contract, sign * quantity, price)
+        self.cash -= sign * quantity * price + commission
+
+        execution = ibi.Execution(execId=str(next(self.execIds)), time=now, acctNumber=self.account,
+                                  side='BOT' if sign > 0 else 'SLD', shares=quantity, price=price,
+                                  orderId=trade.order.orderId, cumQty=quantity, avgPrice=price)
+        report    = ibi.CommissionReport(execId=execution.execId, commission=commission, currency=self.baseCcy,
+                                         realizedPNL=realized)
+        fill      = ibi.Fill(trade.contract, execution, report, now)
+        trade.fills.append(fill)
+        trade.orderStatus.status        = 'Filled'
+        trade.orderStatus.filled        = quantity
+        trade.orderStatus.remaining     = 0
+        trade.orderStatus.avgFillPrice  = price
+        trade.orderStatus.lastFillPrice = price
+        trade.log.append(ibi.TradeLogEntry(now, 'Filled', ''))
+        self.fillList.append(fill)
+
+        self.execDetailsEvent.emit(trade, fill)
+        self.commissionReportEvent.emit(trade, fill, report)
+        self.orderStatusEvent.emit(trade)
+        self.positionEvent.emit(self.getPosition(trade.contract.conId))
+
+    def updatePosition(self, contract, quantity, price):
+        # Average cost on the open side, the closed part realizes P&L.
+        _, position, avgCost = self.positionDict.get(contract.conId, [contract, 0., 0.])
+        realized = 0.
+        if position * quantity < 0:
+            closed    = min(abs(quantity), abs(position)) * np.sign(position)
+            realized  = closed * (price - avgCost)
+            position -= closed
+            quantity += closed
+        if quantity != 0:
+            avgCost   = (position * avgCost + quantity * price) / (position + quantity)
+            position += quantity
+        self.realizedPnl += realized
+        self.positionDict[contract.conId] = [contract, position, avgCost if position != 0 else 0.]
+        return realized
+
+    # ------------------------------------- Portfolio -------------------------------------
+
+    def getPosition(self, conId):
+        contract, position, avgCost = self.positionDict[conId]
+        return ibi.Position(self.account, contract, position, avgCost)
+
+    def positions(self, account=''):
+        return [self.getPosition(conId) for conId in self.positionDict.keys()]
+
+    def reqPositions(self):
+        return self.positions()
+
+    def portfolio(self, account=''):
+        items = list()
+        for contract, position, avgCost in self.positionDict.values():
+            price = self.getPrice(self.getSymbol(contract))
+            items.append(ibi.PortfolioItem(contract, position, price, position * price, avgCost,
+                                           position * (price - avgCost), 0., self.account))
+        return items
+
+    def getNetLiq(self):
+        return self.cash + sum(item.marketValue for item in self.portfolio())
+
+    def accountValues(self, account=''):
+        portfolio = self.portfolio()
+        values    = {'NetLiquidation'    : self.cash + sum(item.marketValue for item in portfolio),
+                     'TotalCashValue'    : self.cash,
+                     'GrossPositionValue': sum(abs(item.marketValue) for item in portfolio),
+                     'RealizedPnL'       : self.realizedPnl,
+                     'UnrealizedPnL'     : sum(item.unrealizedPNL for item in portfolio)}
+        return [ibi.AccountValue(self.account, tag, str(value), self.baseCcy, '') for tag, value in values.items()]
+
+    def accountSummary(self, account=''):
+        return self.accountValues(account)
+
+    def reqAccountUpdates(self, account=''):
+        pass
+
+    def reqAccountSummary(self):
+        pass
+
+    # ------------------------------------- Report -------------------------------------
+
+    @Logger('main', 'info')
+    def getEquityDf(self):
+        return pd.DataFrame(self.equity, columns=['date', 'net_liq'])
+
+    @Logger('main', 'info')
+    def getFillsDf(self):
+        return pd.DataFrame([{'date'      : fill.time,
+                              'symbol'    : fill.contract.localSymbol,
+                              'side'      : fill.execution.side,
+                              'shares'    : fill.execution.shares,
+                              'price'     : fill.execution.price,
+                              'commission': fill.commissionReport.commission,
+                              'realized'  : fill.commissionReport.realizedPNL} for fill in self.fillList])
+
+
+def actionsToPositions(actions):
+    # Hold the side of the latest action, flat before the first one.
+    idx = np.maximum.accumulate(np.where(actions != 0, np.arange(len(actions)), 0))
+    return actions[idx].astype(np.int8)
+
+
+def fillActions(actions, open_, close, quantity=1, commission=0.):
+    # A signal on bar i fills at the open of bar i + 1. The holding is marked at every close, the previous holding
+    # carries over the gap from the last close.
+    positions = actionsToPositions(actions)
+    held      = np.r_[0, positions[:-1]].astype(float) * quantity
+    held_1    = np.r_[0., held[:-1]]
+    close_1   = np.r_[open_[:1], close[:-1]]
+    costs     = np.abs(held - held_1) * open_ * commission
+    pnls      = held_1 * (open_ - close_1) + held * (close - open_) - costs
+    return held, costs, pnls
+
+
+def summarizePnls(actions, held, costs, pnls, initialPosition=0.):
+    # The Sharpe ratio is per bar and not annualized, so it does not grow with the number of bars.
+    equity = np.cumsum(pnls)
+    std    = pnls.std() if len(pnls) > 0 else 0.
+    return {'signals'     : int(np.count_nonzero(actions)),
+            'trades'      : int(np.count_nonzero(np.diff(held, prepend=initialPosition))),
+            'cost'        : float(costs.sum()),
+            'pnl'         : float(pnls.sum()),
+            'max_drawdown': float(np.max(np.maximum.accumulate(equity) - equity)) if len(equity) > 0 else 0.,
+            'sharpe'      : float(pnls.mean() / std) if std > 0 else np.nan}
+
+
+class VectorizedBacktest(object):
+
+    # Research fast path for SingleContractAndBarDataStrategy subclasses over one bar history, using the strategy's
+    # getActionsNp. As with SimulatedBroker, a signal on bar i fills at the open of bar i + 1, and the equity is
+    # marked at every close.
+
+    @Logger('main', 'info')
+    def __init__(self, strategyClass, config, quantity=1, commission=0., initialCash=0.):
+        self.strategyClass = strategyClass
+        self.config        = config
+        self.quantity      = quantity
+        self.commission    = commission     # Fraction of traded notional.
+        self.initialCash   = initialCash
+
+    @Logger('main', 'info')
+    def run(self, df):
+        close = df['close'].to_numpy(dtype=float)
+        high  = df['high' ].to_numpy(dtype=float)
+        low   = df['low'  ].to_numpy(dtype=float)
+        open_ = df['open' ].to_numpy(dtype=float) if 'open' in df.columns else np.r_[close[:1], close[:-1]]
+
+        actions           = self.strategyClass.getActionsNp(self.config, close, high, low)
+        held, costs, pnls = fillActions(actions, open_, close, self.quantity, self.commission)
+        equity            = self.initialCash + np.cumsum(pnls)
+
+        mainLogger.debug(f'Vectorized backtest of {self.strategyClass.__name__} over {len(close)} bars')
+
+        return pd.DataFrame({'date'    : df['date'].reset_index(drop=True),
+                             'close'   : close,
+                             'action'  : actions,
+                             'position': held,
+                             'cost'    : costs,
+                             'pnl'     : pnls,
+                             'equity'  : equity}, copy=False)
+
+    @staticmethod
+    @Logger('main', 'info')
+    def getSummary(result):
+        return summarizePnls(result['action'].to_numpy(), result['position'].to_numpy(), result['cost'].to_numpy(),
+                             result['pnl'].to_numpy())
+
+
+if __name__ == '__main__':
+
+    pass
@@ -49,7 +49,7 @@ class ContractManager(object):
 
     @Logger('main', 'debug')
     def createContract(self, id_, secType, para):
-        contracts = self.ib.qualifyContracts(getattr(ibi.contract, secType)(**para))
+        contracts = self.agent.RequestManager.qualifyContracts(getattr(ibi.contract, secType)(**para))
         self.validateContract(id_, contracts)
         self.contracts[id_] = contracts
 
@@ -57,12 +57,12 @@ class ContractManager(object):
     def createContractDetail(self, id_, contracts):
         details = list()
         for contract in contracts:
-            details.extend(self.ib.reqContractDetails(contract))
+            details.extend(self.agent.RequestManager.reqContractDetails(contract))
         self.contractDetail[id_] = details
 
     @Logger('main', 'debug')
     def setContract(self, id_, contract):
-        self.contracts[id_] = self.ib.qualifyContracts(contract)
+        self.contracts[id_] = self.agent.RequestManager.qualifyContracts(contract)
 
     @Logger('main', 'debug')
     def validateContract(self, id_, contractList):
@@ -0,0 +1,255 @@
+import numpy as np
+import pandas as pd
+from src.util.log_util import *
+
+
+def trueRangeNp(close, high, low, rangeType=None):
+    # True range of each bar against the one before it, one shorter than the inputs.
+    close_1 = close[:-1]
+    high_0  = high[1:]
+    low_0   = low[1:]
+
+    if rangeType is None:
+        return np.maximum.reduce([high_0 - low_0,
+                                  np.abs(high_0 - close_1),
+                                  np.abs(low_0 - close_1)])
+
+    if rangeType == 'full':
+        high_1 = high[:-1]
+        low_1  = low[:-1]
+        return np.maximum.reduce([high_0 - low_0,
+                                  high_1 - low_1,
+                                  np.abs(high_0 - low_1),
+                                  np.abs(high_1 - low_0)])
+
+
+class Indicator(object):
+
+    # Values of one indicator over the bars of one BarStore. Rows are kept at the sequence numbers of the store in a
+    # mirrored buffer of the same capacity, so getArray lines up with the store rows and with barData.df without a
+    # copy. The date of each computed row is kept as well. Only the bars after the last computed one that is still
+    # stored with the same date are computed on update, so a popped open bar costs one row, while bars rewritten
+    # under it, e.g. by a backfill or a reload, are all computed again.
+
+    @Logger('main', 'info')
+    def __init__(self, manager, key, marketDataId):
+        self.manager      = manager
+        self.key          = key
+        self.marketDataId = marketDataId
+        self.sources      = list()   # Indicators this one is computed from, subscribed under its key.
+        self.consumers    = set()
+        self.store        = None
+        self.dates        = None
+        self.values       = None
+        self.tail         = 0        # Sequence number after the last computed bar.
+        self.version      = None
+
+    # ------------------------------------- Basic Functions -------------------------------------
+
+    def getStore(self):
+        return self.manager.agent.MarketDataManager.barDataDict[self.marketDataId].store
+
+    def getArray(self):
+        # Read-only view shared by every consumer, valid until the next update of the bar data.
+        self.update()
+        array = self.values[self.store.getSlice()]
+        array.flags.writeable = False
+        return array
+
+    def compute(self, start):
+        # Values of the store rows from start to the end, the rows before start are already computed.
+        pass
+
+    # ------------------------------------- Update -------------------------------------
+
+    # @Logger('main', 'debug')
+    def update(self):
+        store = self.getStore()
+        if (store is self.store) and (store.version == self.version):
+            return
+
+        if store is not self.store:
+            self.store  = store
+            self.dates  = np.zeros(2 * store.maxLen, dtype=np.int64)
+            self.values = np.full(2 * store.maxLen, np.nan)
+            self.tail   = store.head
+
+        seq = min(self.tail, store.tail) - 1
+        if (seq < store.head) or (store.dates[seq % store.maxLen] != self.dates[seq % store.maxLen]):
+            seq = store.head - 1
+
+        for source in self.sources:
+            source.update()
+
+        start = seq + 1
+        if start < store.tail:
+            pos = np.arange(start, store.tail) % store.maxLen
+            self.dates[pos]  = self.dates[pos + store.maxLen]  = store.dates[pos]
+            self.values[pos] = self.values[pos + store.maxLen] = self.compute(start - store.head)
+        self.tail    = store.tail
+        self.version = store.version
+
+
+class TrueRange(Indicator):
+
+    # True range of the bar before each row against the one before that, so a row only depends on closed bars. The
+    # first two rows are NaN.
+
+    @Logger('main', 'info')
+    def __init__(self, manager, key, marketDataId, rangeType=None):
+        super(TrueRange, self).__init__(manager, key, marketDataId)
+        self.rangeType = rangeType
+
+    def compute(self, start):
+        store  = self.store
+        n      = len(store)
+        lo     = max(start - 2, 0)
+        values = np.full(n - start, np.nan)
+        if n - lo > 2:
+            values[lo + 2 - start:] = trueRangeNp(store.getArray('close')[lo:n - 1],
+                                                  store.getArray('high' )[lo:n - 1],
+                                                  store.getArray('low'  )[lo:n - 1],
+                                                  rangeType=self.rangeType)
+        return values
+
+
+class Atr(Indicator):
+
+    # Mean true range over the last window rows, NaN while any of them is NaN. A batch of rows is computed with a
+    # rolling mean, new bars then step a running sum over the window in O(1) each.
+
+    @Logger('main', 'info')
+    def __init__(self, manager, key, marketDataId, window, rangeType=None):
+        super(Atr, self).__init__(manager, key, marketDataId)
+        self.window    = window
+        self.trueRange = manager.subscribe(key, marketDataId, 'true_range', rangeType=rangeType)
+        self.sources   = [self.trueRange]
+        self.trSum     = 0.
+        self.trNans    = 0
+        self.trCount   = 0
+        self.trHead    = None   # Sequence number of the oldest true range in the running sum.
+        self.trTail    = None   # Sequence number after the newest one.
+
+    def compute(self, start):
+        store = self.store
+        trs   = self.trueRange.values[store.getSlice()]
+        n     = len(trs)
+
+        if (n - start > self.window) or (self.trTail != store.head + start):
+            lo     = max(start - self.window + 1, 0)
+            values = pd.Series(trs[lo:]).rolling(window=self.window).mean().to_numpy()[start - lo:]
+            self.resetTrueRangeSum(trs, n)
+            return values
+
+        values = np.full(n - start, np.nan)
+        for k in range(start, n):
+            self.updateTrueRanges(trs, k)
+            values[k - start] = self.trSum / self.window if self.trNans == 0 else np.nan
+        return values
+
+    # @Logger('main', 'debug')
+    def updateTrueRanges(self, trs, k):
+        # Running sum over the window, any NaN in the window makes the ATR NaN as np.mean would. Slots older than
+        # the sum were counted as NaN.
+        seq = self.store.head + k
+        if seq - self.window >= self.trHead:
+            tr_old = self.trueRange.values[(seq - self.window) % self.store.maxLen]
+            if np.isnan(tr_old):
+                self.trNans -= 1
+            else:
+                self.trSum -= tr_old
+        else:
+            self.trNans -= 1
+
+        tr_0 = trs[k]
+        if np.isnan(tr_0):
+            self.trNans += 1
+        else:
+            self.trSum += tr_0
+        self.trTail = seq + 1
+
+        # Summed again once per window so rounding errors do not accumulate.
+        self.trCount += 1
+        if self.trCount % self.window == 0:
+            self.resetTrueRangeSum(trs, k + 1)
+
+    # @Logger('main', 'debug')
+    def resetTrueRangeSum(self, trs, end):
+        lo          = max(end - self.window, 0)
+        self.trSum  = float(np.nansum(trs[lo:end]))
+        self.trNans = int(np.isnan(trs[lo:end]).sum()) + (self.window - (end - lo))
+        self.trHead = self.store.head + lo
+        self.trTail = self.store.head + end
+
+
+class IndicatorManager(object):
+
+    # Registry of indicators keyed by (market data id, name, parameters). Strategies on the same bars with the same
+    # parameters share one indicator, computed once per new bar. An indicator is evicted when its last consumer
+    # unsubscribes, and releases the indicators it was computed from in turn.
+
+    indicatorClasses = {'true_range': TrueRange,
+                        'atr'       : Atr}
+
+    @Logger('main', 'info')
+    def __init__(self, agent):
+        self.agent      = agent
+        self.config     = None
+        self.indicators = dict()   # Sources are registered before the indicators computed from them.
+
+    # ------------------------------------- Basic Functions -------------------------------------
+
+    @Logger('main', 'debug')
+    def getKey(self, marketDataId, name, params):
+        # Shadows share the indicators of the bar data they read from.
+        barData = self.agent.MarketDataManager.barDataDict[marketDataId]
+        while barData.isShadow and (barData.parent is not None):
+            barData = barData.parent
+        return barData.id, name, tuple(sorted(params.items()))
+
+    @Logger('main', 'info')
+    def subscribe(self, consumerId, marketDataId, name, **params):
+        if name not in self.indicatorClasses:
+            raise ValueError(f'Error:Indicator:{self.__class__.__name__}:subscribe - Unknown indicator {name}.')
+
+        key = self.getKey(marketDataId, name, params)
+        if key not in self.indicators:
+            indicator = self.indicatorClasses[name](self, key, key[0], **params)
+            self.indicators[key] = indicator
+
+            mainLogger.debug(f'Registered indicator {key}')
+
+        indicator = self.indicators[key]
+        indicator.consumers.add(consumerId)
+        return indicator
+
+    @Logger('main', 'info')
+    def unsubscribe(self, consumerId, indicator):
+        indicator.consumers.discard(consumerId)
+        if (len(indicator.consumers) == 0) and (self.indicators.get(indicator.key) is indicator):
+            del self.indicators[indicator.key]
+
+            mainLogger.debug(f'Evicted indicator {indicator.key}')
+
+            for source in indicator.sources:
+                self.unsubscribe(indicator.key, source)
+
+    # ------------------------------------- Initialize -------------------------------------
+
+    @Logger('main', 'info')
+    def initialize(self, config):
+        self.config = config
+
+    # ------------------------------------- Update -------------------------------------
+
+    @Logger('main', 'info')
+    def update(self):
+        # Computed here once per loop for every consumer, later reads find them up to date.
+        for key, indicator in list(self.indicators.items()):
+            if indicator.marketDataId in self.agent.MarketDataManager.barDataDict:
+                indicator.update()
+
+
+if __name__ == '__main__':
+
+    pass
@@ -1,9 +1,12 @@
+import os
+import asyncio
 import pandas as pd
 import numpy as np
 import ib_insync as ibi
+from datetime import timedelta
+from src.util.async_util import gather_with_limit
 from src.util.dt_util import mapBarSize
 from src.util.log_util import *
-from copy import copy
 
 
 pd.set_option('mode.chained_assignment', None)  # Turn off pandas warning.
@@ -47,17 +50,193 @@ class DataInterface(object):
         self.df.reset_index(inplace=True, drop=True)
 
 
+class BarStore(object):
+
+    # Columnar ring buffer of bars with a fixed capacity. Every row is written twice, at pos and pos + maxLen,
+    # so the latest maxLen rows are always one contiguous slice and can be handed out without copying. Bars carry
+    # absolute sequence numbers from head to tail. pop and truncateFrom move the tail back and reuse the numbers
+    # after it, so a cursor is only valid together with the date stored at it, see getDateNs.
+
+    fields = ('open', 'high', 'low', 'close', 'volume', 'average', 'barCount')
+
+    @Logger('main', 'info')
+    def __init__(self, maxLen, fields=None, dtype=None):
+        self.maxLen    = maxLen
+        self.fields    = self.fields if fields is None else tuple(fields)
+        self.fieldIdx  = {field: i for i, field in enumerate(self.fields)}
+        self.dtype     = np.dtype(float if dtype is None else dtype)
+        self.dates     = np.zeros(2 * maxLen, dtype=np.int64)
+        self.values    = np.full((len(self.fields), 2 * maxLen), np.nan, dtype=self.dtype)
+        self.head      = 0      # Sequence number of the first stored bar.
+        self.tail      = 0      # Sequence number after the last stored bar.
+        self.tz        = None
+        self.version   = 0
+        self.dfCache   = None
+        self.dfVersion = None
+
+    def __len__(self):
+        return self.tail - self.head
+
+    # ------------------------------------- Basic Functions -------------------------------------
+
+    @staticmethod
+    def toNs(dates):
+        # Convert datetime-like values to int64 epoch ns, wall-clock for naive and UTC for tz-aware values.
+        if len(dates) == 0:
+            return np.zeros(0, dtype=np.int64)
+        dates = pd.DatetimeIndex(pd.to_datetime(pd.Series(dates)))
+        return dates.as_unit('ns').asi8.copy()
+
+    def barsToArrays(self, bars):
+        dates  = np.array([pd.Timestamp(bar.date).value for bar in bars], dtype=np.int64)
+        values = np.array([[getattr(bar, field) for field in self.fields] for bar in bars], dtype=float)
+        return dates, values.reshape(len(bars), len(self.fields)).T
+
+    def toTimestamp(self, dateNs):
+        return pd.Timestamp(dateNs, tz=self.tz)
+
+    def getSlice(self):
+        start = self.head % self.maxLen
+        return slice(start, start + len(self))
+
+    def getDates(self):
+        return self.dates[self.getSlice()]
+
+    def getArray(self, field):
+        return self.values[self.fieldIdx[field], self.getSlice()]
+
+    def getLastDate(self):
+        return self.toTimestamp(self.dates[(self.tail - 1) % self.maxLen]) if len(self) > 0 else None
+
+    def getPosition(self, seq):
+        # Row of a sequence number in getDf and the arrays, negative once trimmed off the front.
+        return seq - self.head
+
+    def getDateNs(self, seq):
+        return self.dates[seq % self.maxLen] if self.head <= seq < self.tail else None
+
+    def getSeq(self, dateNs):
+        # Sequence number of the first stored bar at or after dateNs.
+        return self.head + int(np.searchsorted(self.getDates(), dateNs, side='left'))
+
+    def getDf(self):
+        # Price columns are views on the buffer, only the date column is materialized when a time zone applies.
+        if len(self) == 0:
+            return None
+        if self.dfVersion != self.version:
+            dates = pd.DatetimeIndex(self.getDates().view('M8[ns]'), copy=False)
+            data  = {'date': dates if self.tz is None else dates.tz_localize(self.tz)}
+            for field in self.fields:
+                data[field] = self.getArray(field)
+            self.dfCache   = pd.DataFrame(data, copy=False)
+            self.dfVersion = self.version
+        return self.dfCache
+
+    # ------------------------------------- Set -------------------------------------
+
+    @Logger('main', 'debug')
+    def setBars(self, bars):
+        self.clear()
+        self.updateBars(bars)
+
+    @Logger('main', 'debug')
+    def setDf(self, df):
+        self.clear()
+        if (df is not None) and (len(df) > 0):
+            dates   = pd.to_datetime(df['date'])
+            self.tz = 'UTC' if dates.dt.tz is not None else None
+            values  = np.vstack([df[field].to_numpy(dtype=float) if field in df else np.full(len(df), np.nan)
+                                 for field in self.fields])
+            self.extend(self.toNs(dates), values)
+
+    @Logger('main', 'debug')
+    def clear(self):
+        # Sequence numbers continue after a clear, so no cursor can match a bar written later.
+        self.head    = self.tail
+        self.version += 1
+
+    # ------------------------------------- Update -------------------------------------
+
+    def updateBars(self, bars):
+        # Merge bars sorted by date, stored bars at or after the first incoming date are replaced.
+        if (bars is None) or (len(bars) == 0):
+            return
+        if len(self) == 0:
+            self.tz = 'UTC' if getattr(bars[0].date, 'tzinfo', None) is not None else None
+        dates, values = self.barsToArrays(bars)
+        if (len(dates) == 1) and (len(self) > 0) and (dates[0] == self.dates[(self.tail - 1) % self.maxLen]):
+            self.replaceLast(values[:, 0])
+        else:
+            self.truncateFrom(dates[0])
+            self.extend(dates, values)
+
+    def append(self, dateNs, row):
+        pos = self.tail % self.maxLen
+        self.dates[pos] = self.dates[pos + self.maxLen] = dateNs
+        self.values[:, pos] = self.values[:, pos + self.maxLen] = row
+        self.tail += 1
+        self.head = max(self.head, self.tail - self.maxLen)
+        self.version += 1
+
+    def extend(self, dates, values):
+        # Only the last maxLen rows can survive, so older incoming rows are skipped.
+        n = min(len(dates), self.maxLen)
+        if n == 0:
+            return
+        pos = (self.tail + len(dates) - n + np.arange(n)) % self.maxLen
+        self.dates[pos] = self.dates[pos + self.maxLen] = dates[-n:]
+        self.values[:, pos] = self.values[:, pos + self.maxLen] = values[:, -n:]
+        self.tail += len(dates)
+        self.head = max(self.head, self.tail - self.maxLen)
+        self.version += 1
+
+    def replaceLast(self, row):
+        pos = (self.tail - 1) % self.maxLen
+        self.values[:, pos] = self.values[:, pos + self.maxLen] = row
+        self.version += 1
+
+    def truncateFrom(self, dateNs):
+        # Drop every stored bar with date at or after dateNs.
+        if (len(self) > 0) and (dateNs <= self.dates[(self.tail - 1) % self.maxLen]):
+            self.tail = self.head + int(np.searchsorted(self.getDates(), dateNs, side='left'))
+            self.version += 1
+
+    def pop(self, n=1):
+        if len(self) > 0:
+            self.tail = max(self.head, self.tail - n)
+            self.version += 1
+
+    def insert(self, dates, values):
+        # Merge bars sorted by date into the stored range, stored bars with the same date are replaced. Only the
+        # rows from the first incoming date onward are rewritten.
+        if len(dates) == 0:
+            return
+        stored     = self.getDates()
+        pos        = int(np.searchsorted(stored, dates[0], side='left'))
+        keep       = ~np.isin(stored[pos:], dates)
+        tailDates  = stored[pos:][keep]
+        tailValues = self.values[:, self.getSlice()][:, pos:][:, keep]
+        allDates   = np.concatenate([dates, tailDates])
+        allValues  = np.hstack([values, tailValues])
+        order      = np.argsort(allDates, kind='stable')
+
+        self.tail = self.head + pos
+        self.extend(allDates[order], allValues[:, order])
+
+
 class BarData(DataInterface):
 
     @Logger('main', 'info')
-    def __init__(self, id_, contract, barSize, maxLen, option, isShadow):
+    def __init__(self, id_, contract, barSize, maxLen, option, isShadow, storage=None):
         super(BarData, self).__init__()
+        self.store        = BarStore(maxLen) if storage is None else BarStore(maxLen, storage['fields'], storage['dtype'])
         self.id           = id_
         self.contract     = contract
         self.barSize      = barSize  # timedelta or relativedelta
         self.maxLen       = maxLen
         self.isShadow     = isShadow
         self.option       = option
+        self.parent       = None
         self.barsH        = None
         self.barsR        = None
         self.pxLast       = None
@@ -66,15 +245,31 @@ class BarData(DataInterface):
         self.isActive     = False
         self.isUpdated    = False
         self.isReady      = False
+        self.isStreaming  = False
+        self.isPolled     = False    # Refreshed by a historical request each update instead of streaming.
+        self.gaps         = dict()   # Missing bar ranges awaiting backfill, start to end date in epoch ns.
+        self.gapMaxNs     = None     # Longer breaks are session closes rather than gaps, None disables detection.
+        self.breaks       = set()    # Time of day and length of breaks IB had no bars for, e.g. a daily settlement.
+        self.barsMaxLen   = None     # Raw bars kept in barsH and barsR once ingested, None keeps all.
+        self.newBarEvent  = ibi.Event('newBarEvent')
         self.updateTime   = {'isActive':None,
                              'isUpdated':None,
                              'isReady':None,
                              'pxLast':None}
 
+    @property
+    def df(self):
+        return self.store.getDf()
+
+    @df.setter
+    def df(self, df):
+        if df is not None:
+            self.store.setDf(df)
+
     @Logger('main', 'info')
     def set(self, barType, bars, currentTime):
         self.setBars(barType, bars)
-        self.setDf(bars) if self.df is None else self.updateBarsToDf(bars)
+        self.setDf(bars) if len(self.store) == 0 else self.updateBarsToDf(bars)
         self.updateForNonShadow(currentTime, isInitializing=True)
 
     @Logger('main', 'debug')
@@ -88,36 +283,99 @@ class BarData(DataInterface):
 
     @Logger('main', 'debug')
     def setDf(self, bars):
-        self.assignDf(ibi.util.df(bars))
-        self.resizeDf()
+        self.store.setBars(bars)
 
     @Logger('main', 'info')
-    def update(self, currentTime, parentBarData=None):
+    def update(self, currentTime):
 
         mainLogger.debug(f'Updating bar data for {self.contract.localSymbol}')
 
-        if self.isShadow is False:
-            self.updateForNonShadow(currentTime, isInitializing=False)
-        else:
-            self.updateForShadow(parentBarData)
+        self.updateForNonShadow(currentTime, isInitializing=False)
 
     @Logger('main', 'debug')
     def updateDf(self, isInitializing):
         if isInitializing is False:
             newBars = self.extractNewBars()
-            self.updateBarsToDf(newBars) if self.df is not None else self.setDf(newBars)
+            self.updateBarsToDf(newBars) if len(self.store) > 0 else self.setDf(newBars)
 
     @Logger('main', 'debug')
     def updateBarsToDf(self, bars):
-        df = ibi.util.df(bars)
-        if df is not None:
-            for _ in range(len(df)):
-                if df['date'].iloc[0] <= self.df['date'].iloc[-1]:
-                    self.df.drop(self.df.tail(1).index, inplace=True)
-                else:
-                    break
-            self.append(df)
-            self.resizeDf()
+        lastDate = self.store.getLastDate()
+        self.store.updateBars(bars)
+        self.updateGaps(lastDate)
+
+    @Logger('main', 'debug')
+    def setGapTracking(self, maxGap):
+        if isinstance(self.barSize, timedelta) and (maxGap is not None):
+            self.gapMaxNs = pd.Timedelta(maxGap).value
+
+    def getBreakKey(self, startNs, endNs):
+        startDate = self.store.toTimestamp(startNs)
+        return startDate.time(), endNs - startNs
+
+    @Logger('main', 'debug')
+    def addBreak(self, startNs, endNs):
+        # A gap a backfill found no bars in is a session break, the same break on later days is not recorded again.
+        self.breaks.add(self.getBreakKey(startNs, endNs))
+
+    @Logger('main', 'debug')
+    def updateGaps(self, lastDate):
+        # Record breaks in the bar cadence longer than one bar, only across the rows merged since lastDate.
+        if (self.gapMaxNs is None) or (len(self.store) < 2):
+            return
+        dates  = self.store.getDates()
+        start  = 0 if lastDate is None else max(int(np.searchsorted(dates, lastDate.value)) - 1, 0)
+        sizeNs = pd.Timedelta(self.barSize).value
+        diffs  = np.diff(dates[start:])
+        for i in np.flatnonzero((diffs > sizeNs) & (diffs <= self.gapMaxNs)):
+            startNs = int(dates[start + i]) + sizeNs
+            endNs   = int(dates[start + i + 1])
+            if self.getBreakKey(startNs, endNs) in self.breaks:
+                continue
+            self.gaps[startNs] = endNs
+
+            mainLogger.debug(f'Gap in bar data {self.id} from {self.store.toTimestamp(dates[start + i])} to {self.store.toTimestamp(dates[start + i + 1])}')
+
+    @Logger('main', 'debug')
+    def setRetention(self, barsMaxLen):
+        # At least two bars, ib_insync ignores updates to an empty list and onBarUpdate reads the one before last.
+        if barsMaxLen is not None:
+            self.barsMaxLen = max(barsMaxLen, 2)
+            self.trimBars()
+
+    @Logger('main', 'debug')
+    def trimBars(self):
+        # Rows already in the store are dropped from the raw bar lists in place, so a live keepUpToDate list stays
+        # bounded over a long run.
+        if self.barsMaxLen is not None:
+            for bars in [self.barsH, self.barsR]:
+                if (bars is not None) and (len(bars) > self.barsMaxLen):
+                    del bars[:len(bars) - self.barsMaxLen]
+
+    @Logger('main', 'debug')
+    def setPolling(self):
+        # The open bar of a polled series is dropped like a streamed one, so the store only holds closed bars.
+        self.isPolled = True
+        self.updateLastOpenRowInDf()
+        self.updateLastDateDf()
+
+    @Logger('main', 'debug')
+    def pollBars(self, bars):
+        if len(bars) > 0:
+            self.setBars('h', bars)
+            self.updateBarsToDf(bars)
+
+    @Logger('main', 'debug')
+    def mergeBars(self, bars):
+        if len(bars) > 0:
+            self.store.insert(*self.store.barsToArrays(bars))
+
+    # @Logger('main', 'debug')
+    def onBarUpdate(self, bars, hasNewBar):
+        # Ingest the bar closed by a new real-time bar, the open bar is left to updateForNonShadow.
+        if hasNewBar and (len(bars) > 1):
+            self.updateBarsToDf(bars[-2:-1])
+            self.newBarEvent.emit(self)
 
     @Logger('main', 'debug')
     def updateForNonShadow(self, currentTime, isInitializing=False):
@@ -131,19 +389,7 @@ class BarData(DataInterface):
             self.updateLastOpenRowInDf()
             self.updateLastDateDf()
             self.updatePxLast(currentTime)
-
-    @Logger('main', 'debug')
-    def updateForShadow(self, parentBarData):
-        self.df           = parentBarData.df
-        self.barsH        = parentBarData.barsH
-        self.barsR        = parentBarData.barsR
-        self.pxLast       = parentBarData.pxLast
-        self.lastDateDf   = parentBarData.lastDateDf
-        self.lastDateBars = parentBarData.lastDateBars
-        self.isActive     = parentBarData.isActive
-        self.isUpdated    = parentBarData.isUpdated
-        self.isReady      = parentBarData.isReady
-        self.updateTime   = parentBarData.updateTime
+            self.trimBars()
 
     @Logger('main', 'debug')
     def updateReadyStatus(self, currentTime, isInitializing):
@@ -154,8 +400,8 @@ class BarData(DataInterface):
 
     @Logger('main', 'debug')
     def updateUpdateStatus(self, currentTime, isInitializing):
-        if self.df is not None:
-            date_0 = self.df['date'].iloc[-1]
+        if len(self.store) > 0:
+            date_0 = self.store.getLastDate()
             self.isUpdated = True if isInitializing else date_0 > self.lastDateDf
 
             mainLogger.debug(f'isUpdated:{self.isUpdated} - date_0:{date_0} - lastDateDf:{self.lastDateDf}')
@@ -164,7 +410,7 @@ class BarData(DataInterface):
 
     @Logger('main', 'debug')
     def updateActiveStatus(self, currentTime):
-        if self.df is not None:
+        if len(self.store) > 0:
             self.isActive = (currentTime - self.lastDateBars) < self.barSize
 
             mainLogger.debug(f'isActive:{self.isActive} - currentTime:{currentTime} - lastDateBars:{self.lastDateBars} - barSize:{self.barSize}')
@@ -183,15 +429,15 @@ class BarData(DataInterface):
 
     @Logger('main', 'debug')
     def updateLastDateDf(self):
-        if self.df is not None:
-            self.lastDateDf = self.df['date'].iloc[-1]
+        if len(self.store) > 0:
+            self.lastDateDf = self.store.getLastDate()
 
     @Logger('main', 'debug')
     def updateLastOpenRowInDf(self):
-        if self.df is not None:
-            if self.option in [3, 4]:
+        if len(self.store) > 0:
+            if (self.option in [3, 4]) or self.isPolled:
                 if self.isActive and (self.lastDateBars == self.lastDateDf):
-                    self.df.drop(self.df.tail(1).index, inplace=True)
+                    self.store.pop()
 
     @Logger('main', 'debug')
     def updatePxLast(self, currentTime):
@@ -206,8 +452,13 @@ class BarData(DataInterface):
     def extractNewBars(self):
         bars = self.barsR
         newBars = list()
+
+        # Closed bars are pushed by onBarUpdate, only the open bar is left.
+        if self.isStreaming and (len(self.store) > 0):
+            return bars[-1:]
+
         if (bars is not None) and len(bars) > 0:
-            if self.df is not None:
+            if len(self.store) > 0:
                 for i in reversed(range(len(bars))):
                     if bars[i].date >= self.lastDateDf:
                         newBars.append(bars[i])
@@ -218,125 +469,744 @@ class BarData(DataInterface):
                 newBars = bars
         return newBars
 
+
+class BarDataShadow(object):
+
+    # View of a parent BarData under another contract, e.g. a CFD on FX bars. Everything except the identity is
+    # resolved from the parent when read, so a shadow costs nothing per update.
+
+    @Logger('main', 'info')
+    def __init__(self, id_, contract, parent):
+        self.id       = id_
+        self.contract = contract
+        self.parent   = parent
+        self.isShadow = True
+
+    def __getattr__(self, name):
+        # Only reached for attributes not set above.
+        if name == 'parent':
+            raise AttributeError(name)
+        return getattr(self.parent, name)
+
+
+class ResampledBarData(BarData):
+
+    # Bars of a larger bar size aggregated locally from a parent BarData, e.g. 5 mins or 1 hour from 1 min bars.
+    # Buckets are aligned to the epoch. Each update aggregates only the parent rows after the last closed bar, and
+    # the still open bar is kept as partialBar until its bucket ends or a later parent row starts the next one.
+
+    @Logger('main', 'info')
+    def __init__(self, id_, parent, barSize, maxLen):
+        if not (isinstance(barSize, timedelta) and isinstance(parent.barSize, timedelta) and barSize > parent.barSize):
+            raise ValueError(f'Error:MarketData:{self.__class__.__name__}:{inspect.currentframe().f_code.co_name} '
+                             f'- Bar size of ID-{id_} needs to be a fixed multiple of its parent bar size.')
+        storage = {'fields': parent.store.fields, 'dtype': parent.store.dtype}
+        super(ResampledBarData, self).__init__(id_, parent.contract, barSize, maxLen, None, isShadow=False, storage=storage)
+        self.parent       = parent
+        self.sizeNs       = pd.Timedelta(barSize).value
+        self.parentSizeNs = pd.Timedelta(parent.barSize).value
+        self.partialBar   = None
+
+    # ------------------------------------- Basic Functions -------------------------------------
+
+    def aggregate(self, dates, values):
+        # Reduce parent rows, grouped by bucket start, to one row per bucket.
+        buckets = dates // self.sizeNs * self.sizeNs
+        starts  = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+        ends    = np.r_[starts[1:], len(dates)] - 1
+        fields  = self.store.fields
+        out     = np.empty((len(fields), len(starts)))
+
+        for i, field in enumerate(fields):
+            arr = values[i]
+            if field == 'open':
+                out[i] = arr[starts]
+            elif field == 'high':
+                out[i] = np.maximum.reduceat(arr, starts)
+            elif field == 'low':
+                out[i] = np.minimum.reduceat(arr, starts)
+            elif field in ['volume', 'barCount']:
+                out[i] = np.add.reduceat(arr, starts)
+            elif field == 'average':
+                # Volume weighted, plain mean where there is no volume as for MIDPOINT bars.
+                volume = values[fields.index('volume')] if 'volume' in fields else np.zeros_like(arr)
+                sumVol = np.add.reduceat(volume, starts)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    weighted = np.add.reduceat(arr * volume, starts) / sumVol
+                    mean     = np.add.reduceat(arr, starts) / np.diff(np.r_[starts, len(dates)])
+                out[i] = np.where(sumVol > 0, weighted, mean)
+            else:
+                out[i] = arr[ends]
+
+        return buckets[starts], out
+
+    def toBar(self, dateNs, row):
+        return ibi.BarData(self.store.toTimestamp(dateNs), **dict(zip(self.store.fields, row.tolist())))
+
+    # ------------------------------------- Update -------------------------------------
+
+    @Logger('main', 'info')
+    def update(self, currentTime, isInitializing=False):
+
+        mainLogger.debug(f'Updating resampled bar data {self.id} for {self.contract.localSymbol}')
+
+        self.isReady = self.parent.isReady
+        self.updateTime['isReady'] = currentTime
+        if self.isReady:
+            self.updateDf(currentTime, isInitializing)
+            self.updateUpdateStatus(currentTime, isInitializing or (self.lastDateDf is None))
+            self.updateLastDateDf()
+            self.isActive = self.parent.isActive
+            self.updateTime['isActive'] = currentTime
+            self.pxLast = self.parent.pxLast
+            self.updateTime['pxLast'] = currentTime
+
     @Logger('main', 'debug')
-    def resizeDf(self):
-        if (self.df is not None) and (len(self.df) > self.maxLen):
-            self.df = self.df.iloc[len(self.df) - self.maxLen:, :]
-            self.df.reset_index(drop=True, inplace=True)
+    def updateDf(self, currentTime, isInitializing=False):
+        src = self.parent.store
+        if len(src) == 0:
+            return
+
+        # Parent rows after the last closed bar, located by date so rewrites and resets of the parent are harmless.
+        srcDates = src.getDates()
+        start    = 0 if len(self.store) == 0 else int(np.searchsorted(srcDates, self.store.getLastDate().value + self.sizeNs))
+        if start == len(srcDates):
+            self.partialBar = None
+            return
+
+        dates, values = self.aggregate(srcDates[start:], np.vstack([src.getArray(field)[start:] for field in self.store.fields]))
+
+        # The last bucket is closed once the parent bar ending it is in, or its end time has passed.
+        lastEnd  = dates[-1] + self.sizeNs
+        isClosed = (srcDates[-1] + self.parentSizeNs >= lastEnd) or (pd.Timestamp(currentTime).value >= lastEnd)
+        nClosed  = len(dates) if isClosed else len(dates) - 1
+
+        self.store.tz = src.tz
+        self.store.extend(dates[:nClosed], values[:, :nClosed])
+        self.partialBar   = None if isClosed else self.toBar(dates[-1], values[:, -1])
+        self.lastDateBars = self.store.toTimestamp(dates[-1])
+
+
+class TickBarData(BarData):
+
+    # Bars built locally from a reqMktData ticker, one price sample per ticker update. Closed bars go to the store,
+    # the open bar is kept as partialBar until a sample of a later bar arrives or update finds its end time passed.
+
+    @Logger('main', 'info')
+    def __init__(self, id_, contract, barSize, maxLen):
+        if not isinstance(barSize, timedelta):
+            raise ValueError(f'Error:MarketData:{self.__class__.__name__}:{inspect.currentframe().f_code.co_name} '
+                             f'- Bar size of ID-{id_} needs to be fixed.')
+        super(TickBarData, self).__init__(id_, contract, barSize, maxLen, None, isShadow=False)
+        self.sizeNs      = pd.Timedelta(barSize).value
+        self.ticker      = None
+        self.isOwnTicker = False    # Requested for this bar data rather than shared with FxData.
+        self.barStart    = None     # Epoch ns of the open bar.
+        self.barValues   = None
+        self.barSumPx    = 0.
+        self.barVolume   = np.nan   # Cumulative ticker volume at the first sample of the open bar.
+        self.partialBar  = None
+        self.store.tz    = 'UTC'
+
+    # ------------------------------------- Basic Functions -------------------------------------
+
+    def toBar(self, dateNs, values):
+        return ibi.BarData(self.store.toTimestamp(dateNs), **values)
+
+    def getLastBar(self):
+        values = {field: self.store.getArray(field)[-1] for field in self.store.fields}
+        return self.toBar(self.store.getLastDate().value, values)
+
+    # @Logger('main', 'debug')
+    def onTicker(self, ticker):
+        price = ticker.marketPrice()
+        if (ticker.time is None) or np.isnan(price):
+            return
+        start = pd.Timestamp(ticker.time).value // self.sizeNs * self.sizeNs
+        if (self.barStart is not None) and (start < self.barStart):
+            return
+
+        if start != self.barStart:
+            self.closeBar()
+            self.barStart  = start
+            self.barSumPx  = 0.
+            self.barVolume = ticker.volume
+            self.barValues = {'open': price, 'high': price, 'low': price, 'close': price, 'volume': 0., 'average': price, 'barCount': 0}
+            self.lastDateBars = self.store.toTimestamp(start)
+
+        values = self.barValues
+        values['high'    ] = max(values['high'], price)
+        values['low'     ] = min(values['low'], price)
+        values['close'   ] = price
+        values['volume'  ] = ticker.volume - self.barVolume
+        values['barCount'] += 1
+        self.barSumPx      += price
+        values['average' ] = self.barSumPx / values['barCount']
+        self.partialBar    = self.toBar(start, values)
+
+    # @Logger('main', 'debug')
+    def closeBar(self):
+        if self.barStart is not None:
+            self.store.append(self.barStart, [self.barValues.get(field, np.nan) for field in self.store.fields])
+            self.barStart   = None
+            self.partialBar = None
+            self.newBarEvent.emit(self)
+
+    # ------------------------------------- Update -------------------------------------
+
+    @Logger('main', 'info')
+    def update(self, currentTime, isInitializing=False):
+
+        mainLogger.debug(f'Updating tick bar data {self.id} for {self.contract.localSymbol}')
+
+        if (self.barStart is not None) and (pd.Timestamp(currentTime).value >= self.barStart + self.sizeNs):
+            self.closeBar()
+
+        self.isReady = len(self.store) > 0
+        self.updateTime['isReady'] = currentTime
+        if self.isReady:
+            self.updateUpdateStatus(currentTime, isInitializing or (self.lastDateDf is None))
+            self.updateActiveStatus(currentTime)
+            self.updateLastDateDf()
+            self.pxLast = self.partialBar if self.partialBar is not None else self.getLastBar()
+            self.updateTime['pxLast'] = currentTime
 
 
 class FxData(DataInterface):
 
     @Logger('main', 'info')
-    def __init__(self, ib, baseCcy, filePath, updateTimeOut=0):
+    def __init__(self, ib, requestManager, baseCcy, filePath, readyTimeOut=30):
         super(FxData, self).__init__()
         self.ib = ib
+        self.requestManager = requestManager
         self.baseCcy = baseCcy
         self.filePath = filePath
-        self.updateTimeOut = updateTimeOut
+        self.readyTimeOut = readyTimeOut
+        self.readyFutures = None    # Resolved with the first rate of each currency.
+        self.currencies = None      # Base currency first, then the currency of each pair row.
+        self.ccyIdx     = None
+        self.tickers    = None
+        self.inverse    = None
+        self.toBase     = None      # Value of one unit of each currency in base currency.
+        self.matrix     = None      # matrix[i, j] is the value of one unit of currency i in currency j.
 
     @Logger('main', 'info')
-    def set(self):
+    def set(self, requiredCcys=None):
         df = pd.read_csv(self.filePath)
         df = df.loc[df['IB SYMBOL'].apply(lambda x: self.baseCcy in x) & df['IS APPLIED'], :]
         df.reset_index(drop=True, inplace=True)
         df['domestic ccy'] = df['IB SYMBOL'].apply(lambda x: x[:3])
         df['foreign ccy' ] = df['IB SYMBOL'].apply(lambda x: x[4:])
         df['symbol'      ] = df['IB SYMBOL'].apply(lambda x: x.replace('.', ''))
-        df['contract'    ] = df['symbol'   ].apply(lambda x: self.ib.qualifyContracts(ibi.Forex(x))[0])
-        df['ticker'      ] = df['contract' ].apply(lambda x: self.ib.reqMktData(x, snapshot=False))
+        df['contract'    ] = df['symbol'   ].apply(lambda x: ibi.Forex(x))
+
+        df = self.qualifyContracts(df)
+        df['ticker'      ] = ibi.util.run(self.reqTickersAsync(df['contract'].to_list()))
         df['inverse'     ] = df['domestic ccy'] == self.baseCcy
         df['fx'          ] = np.nan
 
         idx = df['inverse']
         df['currency'] = df['domestic ccy'].to_list()
-        df['currency'].loc[idx] = df['foreign ccy'].loc[idx]
+        df.loc[idx, 'currency'] = df['foreign ccy'].loc[idx]
         df['pair'    ] = df['currency'] + self.baseCcy
 
         col_keep = ['pair', 'contract', 'ticker', 'inverse', 'currency', 'fx']
         df = df[col_keep]
 
         self.assignDf(df)
+        self.setMatrix()
+        self.setReadyFutures()
+        self.update()
+
+        self.ib.pendingTickersEvent += self.onPendingTickers
+        ibi.util.run(self.waitReadyAsync(requiredCcys))
+
+    @Logger('main', 'debug')
+    def qualifyContracts(self, df):
+        # One request for all pairs, pairs IB cannot qualify are left out.
+        self.requestManager.qualifyContracts(*df['contract'].to_list())
+        isQualified = df['contract'].apply(lambda x: x.conId > 0)
+        for symbol in df['symbol'].loc[~isQualified]:
+            mainLogger.warning(f'Unable to qualify FX pair {symbol}, pair skipped.')
+        return df.loc[isQualified].reset_index(drop=True)
+
+    @Logger('main', 'debug')
+    async def reqTickersAsync(self, contracts):
+        return await asyncio.gather(*[self.requestManager.reqMktDataAsync(contract, snapshot=False) for contract in contracts])
+
+    @Logger('main', 'debug')
+    def setReadyFutures(self):
+        loop = ibi.util.getLoop()
+        self.readyFutures = {ccy: loop.create_future() for ccy in self.df['currency']}
+
+    @Logger('main', 'debug')
+    async def waitReadyAsync(self, ccys=None):
+        # Wait until the given currencies, all by default, are priced. The rest keep resolving in the background.
+        ccys    = list(self.readyFutures.keys()) if ccys is None else [ccy for ccy in ccys if ccy != self.baseCcy]
+        futures = [self.readyFutures[ccy] for ccy in ccys if ccy in self.readyFutures]
+        if len(futures) > 0:
+            await asyncio.wait(futures, timeout=self.readyTimeOut)
+
+        for ccy in ccys:
+            future = self.readyFutures.get(ccy)
+            if (future is None) or (future.done() is False):
+                mainLogger.warning(f'No FX rate for {ccy} within {self.readyTimeOut} seconds.')
+
+    def onPendingTickers(self, tickers):
+        # Only needed until every currency has its first rate.
         self.update()
+        if all(future.done() for future in self.readyFutures.values()):
+            self.ib.pendingTickersEvent -= self.onPendingTickers
 
-        while self.df['fx'].isnull().any():
-            self.ib.waitOnUpdate(self.updateTimeOut)
-            self.update()
+    @Logger('main', 'debug')
+    def setMatrix(self):
+        self.currencies = [self.baseCcy] + self.df['currency'].to_list()
+        self.ccyIdx     = pd.Index(self.currencies)
+        self.tickers    = self.df['ticker'].to_numpy()
+        self.inverse    = self.df['inverse'].to_numpy(dtype=bool)
+        self.toBase     = np.ones(len(self.currencies))
+        self.matrix     = np.ones((len(self.currencies), len(self.currencies)))
+
+    @Logger('main', 'debug')
+    def drop(self, col, val):
+        # The arrays read by update follow the rows of df, so they are set again for the remaining pairs.
+        super(FxData, self).drop(col, val)
+        self.setMatrix()
+        self.readyFutures = {ccy: self.readyFutures[ccy] for ccy in self.df['currency'] if ccy in self.readyFutures}
+        self.update()
 
     @Logger('main', 'info')
     def update(self):
-        idx = self.df['inverse']
-        self.df['fx'] = self.df['ticker'].apply(lambda x: x.marketPrice())
-        self.df['fx'].loc[idx] = 1 / self.df['fx'].loc[idx]
+        px = np.fromiter((ticker.marketPrice() for ticker in self.tickers), dtype=float, count=len(self.tickers))
+        fx = np.where(self.inverse, 1 / px, px)
+        self.df['fx'] = fx
+
+        # Cross rates are triangulated through the base currency.
+        self.toBase[1:] = fx
+        self.matrix     = self.toBase[:, None] / self.toBase[None, :]
+
+        self.updateReadyFutures(fx)
+
+    @Logger('main', 'debug')
+    def updateReadyFutures(self, fx):
+        for ccy, rate in zip(self.currencies[1:], fx):
+            future = self.readyFutures[ccy]
+            if (future.done() is False) and (not np.isnan(rate)):
+                future.set_result(rate)
 
+    @Logger('main', 'debug')
+    def getTicker(self, conId):
+        for contract, ticker in zip(self.df['contract'], self.tickers):
+            if contract.conId == conId:
+                return ticker
+        return None
 
-class StatusData(DataInterface):
+    # ------------------------------------- Conversion -------------------------------------
+
+    @Logger('main', 'debug')
+    def getCcyIdx(self, ccys):
+        idx = self.ccyIdx.get_indexer(np.atleast_1d(ccys))
+        if (idx < 0).any():
+            raise KeyError(f'Error:MarketData:{self.__class__.__name__}:{inspect.currentframe().f_code.co_name} '
+                           f'- No FX rate for {np.atleast_1d(ccys)[idx < 0]}.')
+        return idx
+
+    @Logger('main', 'debug')
+    def getRate(self, fromCcy, toCcy):
+        fromIdx, toIdx = self.getCcyIdx([fromCcy, toCcy])
+        return self.matrix[fromIdx, toIdx]
+
+    @Logger('main', 'debug')
+    def convert(self, amounts, fromCcys, toCcy=None):
+        # Convert amounts held in fromCcys into toCcy, the base currency by default.
+        toCcy   = self.baseCcy if toCcy is None else toCcy
+        fromIdx = self.getCcyIdx(fromCcys)
+        toIdx   = self.getCcyIdx(toCcy)[0]
+        return np.asarray(amounts, dtype=float) * self.matrix[fromIdx, toIdx]
+
+
+class IndexedData(DataInterface):
+
+    # Per-ID table held as arrays with a fixed ID to row index, times are int64 epoch ns. The DataFrame is only
+    # built when read.
+
+    columns = ()
+
+    @Logger('main', 'info')
+    def __init__(self):
+        super(IndexedData, self).__init__()
+        self.ids       = list()
+        self.contracts = list()
+        self.idIdx     = dict()
+        self.conIdIdx  = dict()
+        self.arrays    = dict()
+        self.tz        = None
+
+    # ------------------------------------- Basic Functions -------------------------------------
+
+    @property
+    def df(self):
+        data = {'contract': self.contracts, 'id': self.ids}
+        for col, arr in self.arrays.items():
+            data[col] = self.fromNs(arr) if arr.dtype == np.int64 else arr
+        return pd.DataFrame(data, columns=['contract', 'id'] + list(self.columns))
+
+    @df.setter
+    def df(self, df):
+        pass
+
+    @staticmethod
+    def toList(val):
+        return [val] if isinstance(val, list) is not True else val
+
+    def toNs(self, times):
+        if self.tz is None:
+            self.tz = next((t.tzinfo for t in times if (t is not None) and (t is not pd.NaT)), None)
+        return np.array([pd.Timestamp(t).value for t in times], dtype=np.int64)
+
+    def fromNs(self, arr):
+        dates = pd.DatetimeIndex(arr.view('M8[ns]'))
+        return dates.tz_localize('UTC').tz_convert(self.tz) if self.tz is not None else dates
+
+    def getRows(self, ids):
+        return np.array([self.idIdx[id_] for id_ in ids], dtype=np.int64)
+
+    def getRow(self, id_):
+        return self.idIdx[id_]
+
+    def getRowByConId(self, conId):
+        # Most recently updated row among the series of a contract.
+        rows = self.conIdIdx.get(conId)
+        if rows is None:
+            return None
+        return rows[int(np.argmax(self.arrays['update_time'][rows]))] if len(rows) > 1 else rows[0]
+
+    @Logger('main', 'debug')
+    def setIndex(self, ids, contracts):
+        self.ids       = list(ids)
+        self.contracts = list(contracts)
+        self.idIdx     = {id_: i for i, id_ in enumerate(self.ids)}
+        self.conIdIdx  = dict()
+        for i, contract in enumerate(self.contracts):
+            self.conIdIdx.setdefault(getattr(contract, 'conId', None), list()).append(i)
+
+    @Logger('main', 'debug')
+    def drop(self, col, val):
+        values = self.ids if col == 'id' else self.contracts
+        keep   = [i for i, v in enumerate(values) if v != val]
+        self.setIndex([self.ids[i] for i in keep], [self.contracts[i] for i in keep])
+        for col_ in self.arrays.keys():
+            self.arrays[col_] = self.arrays[col_][keep]
+
+
+class StatusData(IndexedData):
+
+    columns = ('status', 'update_time')
 
     @Logger('main', 'info')
     def __init__(self, statusType):
         super(StatusData, self).__init__()
-        self.df = pd.DataFrame(columns=['contract', 'id', 'status', 'update_time'])
         self.statusType = statusType
 
     @Logger('main', 'info')
     def set(self, ids, contracts, status, updateTimes):
-        ids         = [ids        ] if isinstance(ids,         list) is not True else ids
-        contracts   = [contracts  ] if isinstance(contracts,   list) is not True else contracts
-        status      = [status     ] if isinstance(status,      list) is not True else status
-        updateTimes = [updateTimes] if isinstance(updateTimes, list) is not True else updateTimes
-
-        df = pd.DataFrame({'id':ids,
-                           'contract':contracts,
-                           'status':status,
-                           'update_time':updateTimes})
-        self.assignDf(df)
+        ids         = self.toList(ids)
+        contracts   = self.toList(contracts)
+        status      = self.toList(status)
+        updateTimes = self.toList(updateTimes)
+
+        self.setIndex(ids, contracts)
+        self.arrays = {'status'     : np.array(status, dtype=bool),
+                       'update_time': self.toNs(updateTimes)}
 
     @Logger('main', 'info')
-    def update(self, id_, status, updateTime):
-        self.df['status'     ].loc[self.df['id'] == id_] = status
-        self.df['update_time'].loc[self.df['id'] == id_] = updateTime
+    def update(self, ids, status, updateTimes):
+        rows = self.getRows(self.toList(ids))
+        self.arrays['status'     ][rows] = self.toList(status)
+        self.arrays['update_time'][rows] = self.toNs(self.toList(updateTimes))
 
+    @Logger('main', 'debug')
+    def getStatus(self, id_):
+        return bool(self.arrays['status'][self.getRow(id_)])
+
+    @Logger('main', 'debug')
+    def getStatusByConId(self, conId):
+        row = self.getRowByConId(conId)
+        return bool(self.arrays['status'][row]) if row is not None else None
+
+
+class PxLastData(IndexedData):
 
-class PxLastData(DataInterface):
+    columns = ('close', 'px_time', 'update_time')
 
     @Logger('main', 'info')
     def __init__(self):
         super(PxLastData, self).__init__()
-        self.df = pd.DataFrame(columns=['contract', 'id', 'close', 'px_time', 'update_time'])
 
     @Logger('main', 'info')
     def set(self, contracts, ids, closes, lastDateBars, updateTimes):
-        contracts    = [contracts   ] if isinstance(contracts,    list) is not True else contracts
-        ids          = [ids         ] if isinstance(ids,          list) is not True else ids
-        closes       = [closes      ] if isinstance(closes,       list) is not True else closes
-        lastDateBars = [lastDateBars] if isinstance(lastDateBars, list) is not True else lastDateBars
-        updateTimes  = [updateTimes ] if isinstance(updateTimes,  list) is not True else updateTimes
-
-        df = pd.DataFrame({'contract':contracts,
-                           'id':ids,
-                           'close':closes,
-                           'px_time':lastDateBars,
-                           'update_time':updateTimes})
-        self.assignDf(df)
+        contracts    = self.toList(contracts)
+        ids          = self.toList(ids)
+        closes       = self.toList(closes)
+        lastDateBars = self.toList(lastDateBars)
+        updateTimes  = self.toList(updateTimes)
+
+        self.setIndex(ids, contracts)
+        self.arrays = {'close'      : np.array(closes, dtype=float),
+                       'px_time'    : self.toNs(lastDateBars),
+                       'update_time': self.toNs(updateTimes)}
+
+    @Logger('main', 'info')
+    def update(self, ids, closes, lastDateBars, updateTimes):
+        rows = self.getRows(self.toList(ids))
+        self.arrays['close'      ][rows] = self.toList(closes)
+        self.arrays['px_time'    ][rows] = self.toNs(self.toList(lastDateBars))
+        self.arrays['update_time'][rows] = self.toNs(self.toList(updateTimes))
+
+    @Logger('main', 'debug')
+    def getClose(self, id_):
+        return self.arrays['close'][self.getRow(id_)]
+
+    @Logger('main', 'debug')
+    def getCloseByConId(self, conId):
+        row = self.getRowByConId(conId)
+        return self.arrays['close'][row] if row is not None else np.nan
+
+
+class BarPanel(object):
+
+    # Time x instrument arrays per field, aligned on the union of the bar dates of several series. Each update only
+    # writes the rows from the last date seen per instrument onward. Rows live in a buffer of twice maxLen that is
+    # compacted when full, so every field stays one contiguous block.
+
+    fields = ('open', 'high', 'low', 'close')
+
+    @Logger('main', 'info')
+    def __init__(self, maxLen, fields=None):
+        self.maxLen   = maxLen
+        self.fields   = self.fields if fields is None else tuple(fields)
+        self.fieldIdx = {field: i for i, field in enumerate(self.fields)}
+        self.ids      = None
+        self.idIdx    = None
+        self.dates    = None
+        self.values   = None     # values[field, row, instrument]
+        self.observed = None     # observed[row, instrument] is False where the instrument has no bar.
+        self.lastNs   = None     # Last date written per instrument.
+        self.start    = 0
+        self.end      = 0
+        self.tz       = None
+
+    # ------------------------------------- Basic Functions -------------------------------------
+
+    def __len__(self):
+        return self.end - self.start
+
+    def getDates(self):
+        return self.dates[self.start:self.end]
+
+    def getArray(self, field):
+        return self.values[self.fieldIdx[field], self.start:self.end]
+
+    def getMask(self):
+        return self.observed[self.start:self.end]
+
+    def getStaleMask(self):
+        # Instruments without a bar at the latest date.
+        return self.lastNs < self.dates[self.end - 1] if len(self) > 0 else np.ones(len(self.ids), dtype=bool)
+
+    def getDf(self, field):
+        dates = pd.DatetimeIndex(self.getDates().view('M8[ns]'))
+        dates = dates if self.tz is None else dates.tz_localize(self.tz)
+        return pd.DataFrame(self.getArray(field), index=dates, columns=self.ids, copy=False)
+
+    # ------------------------------------- Set -------------------------------------
+
+    @Logger('main', 'debug')
+    def set(self, ids, barDataDict):
+        self.ids      = list(ids)
+        self.idIdx    = {id_: j for j, id_ in enumerate(self.ids)}
+        self.dates    = np.zeros(2 * self.maxLen, dtype=np.int64)
+        self.values   = np.full((len(self.fields), 2 * self.maxLen, len(self.ids)), np.nan)
+        self.observed = np.zeros((2 * self.maxLen, len(self.ids)), dtype=bool)
+        self.lastNs   = np.full(len(self.ids), np.iinfo(np.int64).min, dtype=np.int64)
+        self.start    = 0
+        self.end      = 0
+        self.update(barDataDict)
+
+    # ------------------------------------- Update -------------------------------------
+
+    @Logger('main', 'debug')
+    def update(self, barDataDict):
+        stores = [barDataDict[id_].store for id_ in self.ids]
+        news   = list()
+        for j, store in enumerate(stores):
+            if len(store) == 0:
+                news.append(None)
+                continue
+            if self.tz is None:
+                self.tz = store.tz
+
+            # Rows after the series' last date were open bars it has dropped since.
+            dates = store.getDates()
+            if dates[-1] < self.lastNs[j]:
+                self.clearAfter(j, dates[-1])
+
+            # The last written row is written again as it may have been an open bar.
+            pos = int(np.searchsorted(dates, self.lastNs[j], side='left'))
+            news.append((pos, dates[pos:]) if pos < len(dates) else None)
+
+        newDates = [new[1] for new in news if new is not None]
+        if len(newDates) == 0:
+            return
+        self.addDates(np.unique(np.concatenate(newDates)))
+
+        axis = self.getDates()
+        for j, (store, new) in enumerate(zip(stores, news)):
+            if new is None:
+                continue
+            pos, dates = new
+            skip = int(np.searchsorted(dates, axis[0], side='left'))    # Older than the panel keeps.
+            rows = self.start + np.searchsorted(axis, dates[skip:])
+            for i, field in enumerate(self.fields):
+                self.values[i, rows, j] = store.getArray(field)[pos + skip:] if field in store.fieldIdx else np.nan
+            self.observed[rows, j] = True
+            self.lastNs[j]         = dates[-1]
+
+    @Logger('main', 'debug')
+    def addDates(self, newDates):
+        axis    = self.getDates()
+        missing = newDates[~np.isin(newDates, axis)]
+        if len(missing) == 0:
+            return
+        if (len(axis) > 0) and (missing[0] < axis[-1]):
+            self.rebuild(np.union1d(axis, missing))
+        elif len(missing) >= self.maxLen:
+            self.rebuild(missing)
+        else:
+            self.append(missing)
+
+    def append(self, dates):
+        # Move the rows still needed to the front once the buffer is full.
+        n = len(dates)
+        if self.end + n > 2 * self.maxLen:
+            keep = min(len(self), self.maxLen - n)
+            self.dates[:keep]     = self.dates[self.end - keep:self.end]
+            self.values[:, :keep] = self.values[:, self.end - keep:self.end]
+            self.observed[:keep]  = self.observed[self.end - keep:self.end]
+            self.start, self.end  = 0, keep
+        self.dates[self.end:self.end + n]     = dates
+        self.values[:, self.end:self.end + n] = np.nan
+        self.observed[self.end:self.end + n]  = False
+        self.end  += n
+        self.start = max(self.start, self.end - self.maxLen)
+
+    def rebuild(self, axis):
+        # Slow path for dates arriving out of order, existing rows are moved onto the new axis.
+        axis     = axis[-self.maxLen:]
+        oldAxis  = self.getDates()
+        isKept   = oldAxis >= axis[0]
+        rows     = np.searchsorted(axis, oldAxis[isKept])
+        values   = np.full_like(self.values, np.nan)
+        observed = np.zeros_like(self.observed)
+        values[:, rows]  = self.values[:, self.start:self.end][:, isKept]
+        observed[rows]   = self.getMask()[isKept]
+
+        self.values, self.observed = values, observed
+        self.dates[:len(axis)]     = axis
+        self.start, self.end       = 0, len(axis)
+
+    def clearAfter(self, j, dateNs):
+        rows = self.start + int(np.searchsorted(self.getDates(), dateNs, side='right'))
+        self.values[:, rows:self.end, j] = np.nan
+        self.observed[rows:self.end, j]  = False
+        self.lastNs[j] = dateNs
+
+    @Logger('main', 'debug')
+    def drop(self, id_):
+        j = self.idIdx.pop(id_, None)
+        if j is not None:
+            self.values   = np.delete(self.values, j, axis=2)
+            self.observed = np.delete(self.observed, j, axis=1)
+            self.lastNs   = np.delete(self.lastNs, j)
+            del self.ids[j]
+            self.idIdx = {id_: j for j, id_ in enumerate(self.ids)}
+
+
+class BarCache(object):
+
+    # On-disk columnar copy of historical bars, one npz file per contract conId, bar size and data type.
 
     @Logger('main', 'info')
-    def update(self, id_, close, lastDateBars, updateTime):
-        self.df['close'      ].loc[self.df['id'] == id_] = close
-        self.df['px_time'    ].loc[self.df['id'] == id_] = lastDateBars
-        self.df['update_time'].loc[self.df['id'] == id_] = updateTime
+    def __init__(self, dirPath):
+        self.dirPath = dirPath
+        os.makedirs(dirPath, exist_ok=True)
+
+    # ------------------------------------- Basic Functions -------------------------------------
+
+    @Logger('main', 'debug')
+    def getFilePath(self, contract, para):
+        key = f"{contract.conId}_{para['barSizeSetting']}_{para['whatToShow']}".replace(' ', '')
+        return os.path.join(self.dirPath, key + '.npz')
+
+    @Logger('main', 'debug')
+    def load(self, contract, para, startDate, store):
+        # Fill the store with cached bars from startDate, only if the cache reaches back that far.
+        filePath = self.getFilePath(contract, para)
+        if os.path.exists(filePath) is False:
+            return False
+
+        with np.load(filePath) as data:
+            dates  = data['dates']
+            values = data['values']
+            fields = data['fields'].tolist()
+            tz     = str(data['tz'])
+
+        startNs = pd.Timestamp(startDate).value
+        if (len(dates) == 0) or (dates[0] > startNs):
+            return False
+
+        idx    = int(np.searchsorted(dates, startNs, side='left'))
+        values = np.vstack([values[fields.index(field), idx:] if field in fields else np.full(len(dates) - idx, np.nan)
+                            for field in store.fields])
+        store.tz = tz if tz != '' else None
+        store.extend(dates[idx:], values)
+
+        mainLogger.debug(f'Loaded {len(dates) - idx} cached bars for {contract.localSymbol} from {filePath}')
+
+        return len(store) > 0
+
+    @Logger('main', 'debug')
+    def save(self, contract, para, store):
+        if len(store) > 0:
+            filePath = self.getFilePath(contract, para)
+            tempPath = filePath + '.tmp'
+            with open(tempPath, 'wb') as f:
+                np.savez(f,
+                         dates=store.getDates(),
+                         values=np.vstack([store.getArray(field) for field in store.fields]),
+                         fields=np.array(store.fields),
+                         tz=np.array(store.tz if store.tz is not None else ''))
+            os.replace(tempPath, filePath)
 
 
 class BarDataRequestor(object):
 
     @Logger('main', 'info')
-    def __init__(self, ib):
-        self.ib = ib
+    def __init__(self, ib, requestManager, cache=None):
+        self.ib             = ib
+        self.requestManager = requestManager
+        self.cache          = cache
 
     @Logger('main', 'debug')
     def reqConsecutiveBars(self, contract, para, startDate):
+        return ibi.util.run(self.reqConsecutiveBarsAsync(contract, para, startDate))
+
+    @Logger('main', 'debug')
+    async def reqConsecutiveBarsAsync(self, contract, para, startDate):
         barsList = []
         while True:
-            bars = self.ib.reqHistoricalData(contract, **para)
+            priority = 'live' if para['endDateTime'] == '' else 'backfill'
+            bars = await self.requestManager.reqHistoricalDataAsync(contract, priority, **para)
             if bars[0].date <= startDate:
                 bars = [bar for bar in bars if bar.date >= startDate] if bars[0].date < startDate else bars
                 barsList.append(bars)
@@ -351,30 +1221,92 @@ class BarDataRequestor(object):
         return barsOut
 
     @Logger('main', 'debug')
-    def createBarData(self, id_, contract, para, option, currentTime, startDate=None, updateFunc=None, dfBase=None, maxLen=100000):
+    async def reqCachedConsecutiveBarsAsync(self, barData, contract, para, startDate, currentTime):
+        # Request only the bars after the cached or inherited range, the last stored bar is re-requested as it may
+        # have been incomplete. The first page is sized to that gap instead of the configured duration.
+        if (len(barData.store) == 0) and (self.cache is not None):
+            self.cache.load(contract, para, startDate, barData.store)
 
+        if len(barData.store) > 0:
+            startDate = max(barData.store.getLastDate(), pd.Timestamp(startDate))
+            endDate   = pd.Timestamp(currentTime if para['endDateTime'] == '' else para['endDateTime'])
+            if endDate > startDate:
+                para = dict(para)
+                para['durationStr'] = self.getDurationStr(endDate - startDate)
+
+        return await self.reqConsecutiveBarsAsync(contract, para, startDate)
+
+    @Logger('main', 'debug')
+    async def reqBarsBetweenAsync(self, contract, para, startDate, endDate):
+        # Bars in [startDate, endDate) from a single request ending at endDate.
+        para = dict(para)
+        para['keepUpToDate'] = False
+        para['endDateTime' ] = endDate
+        para['durationStr' ] = self.getDurationStr(endDate - startDate)
+        bars = await self.requestManager.reqHistoricalDataAsync(contract, 'backfill', **para)
+        return [bar for bar in bars if startDate <= bar.date < endDate]
+
+    @Logger('main', 'debug')
+    async def reqBarsSinceAsync(self, contract, para, startDate, currentTime):
+        # Bars from startDate up to and including the open bar, without streaming.
+        para = dict(para)
+        para['keepUpToDate'] = False
+        para['endDateTime' ] = ''
+        para['durationStr' ] = self.getDurationStr(currentTime - startDate)
+        bars = await self.requestManager.reqHistoricalDataAsync(contract, 'live', **para)
+        return [bar for bar in bars if bar.date >= startDate]
+
+    @Logger('main', 'debug')
+    async def reqStreamingBarsSinceAsync(self, contract, para, startDate, currentTime):
+        # Re-arm keepUpToDate starting from startDate instead of the full configured duration.
+        para = dict(para)
+        para['keepUpToDate'] = True
+        para['endDateTime' ] = ''
+        if startDate is not None:
+            para['durationStr'] = self.getDurationStr(currentTime - startDate)
+        return await self.requestManager.reqHistoricalDataAsync(contract, 'live', **para)
+
+    @staticmethod
+    def getDurationStr(duration):
+        seconds = int(np.ceil(duration.total_seconds()))
+        return f'{seconds} S' if seconds <= 86400 else f'{int(np.ceil(seconds / 86400))} D'
+
+    @Logger('main', 'debug')
+    def saveCache(self, barData, contract, para):
+        if self.cache is not None:
+            self.cache.save(contract, para, barData.store)
+
+    @Logger('main', 'debug')
+    def createBarData(self, id_, contract, para, option, currentTime, startDate=None, updateFunc=None, dfBase=None, maxLen=100000, storage=None):
+        return ibi.util.run(self.createBarDataAsync(id_, contract, para, option, currentTime, startDate, updateFunc, dfBase, maxLen, storage))
+
+    @Logger('main', 'debug')
+    async def createBarDataAsync(self, id_, contract, para, option, currentTime, startDate=None, updateFunc=None, dfBase=None, maxLen=100000, storage=None):
+
+        para    = dict(para)    # Paging below modifies the parameters, keep the shared config intact.
         barSize = mapBarSize(para['barSizeSetting'])
-        barData = BarData(id_, contract, barSize, maxLen, option, isShadow=False)
+        barData = BarData(id_, contract, barSize, maxLen, option, isShadow=False, storage=storage)
 
         if dfBase is not None:
             barData.df = dfBase
 
         # Historical bars.
         if option == 1:
-            bars = self.ib.reqHistoricalData(contract, **para)
+            bars = await self.requestManager.reqHistoricalDataAsync(contract, 'live', **para)
             barData.set('h', bars, currentTime)
 
         # Consecutive historical bars.
         elif option == 2:
-            bars = self.reqConsecutiveBars(contract, para, startDate)
+            bars = await self.reqCachedConsecutiveBarsAsync(barData, contract, para, startDate, currentTime)
             barData.set('h', bars, currentTime)
+            self.saveCache(barData, contract, para)
 
         # Historical bars with real-time update.
         elif option == 3:
             assert para['keepUpToDate'], \
                 f'Error:MarketData:{self.__class__.__name__}:{inspect.currentframe().f_code.co_name} ' \
                 f'- Parameter keepUpToDate needs to be True for real-time request ID-{id_}.'
-            bars = self.ib.reqHistoricalData(contract, **para)
+            bars = await self.requestManager.reqHistoricalDataAsync(contract, 'live', **para)
             if updateFunc is not None:
                 bars.updateEvent += updateFunc
             barData.set('r', bars, currentTime)
@@ -383,12 +1315,12 @@ class BarDataRequestor(object):
         elif option == 4:
             para['keepUpToDate'] = False
             para['endDateTime' ] = ''
-            bars = self.reqConsecutiveBars(contract, para, startDate)
+            bars = await self.reqCachedConsecutiveBarsAsync(barData, contract, para, startDate, currentTime)
             barData.set('h', bars, currentTime)
+            self.saveCache(barData, contract, para)
 
-            para['keepUpToDate'] = True
-            para['endDateTime' ] = ''
-            bars = self.ib.reqHistoricalData(contract, **para)
+            # The stream only needs to cover the bars since the history just stored.
+            bars = await self.reqStreamingBarsSinceAsync(contract, para, barData.store.getLastDate(), currentTime)
             if updateFunc is not None:
                 bars.updateEvent += updateFunc
             barData.set('r', bars, currentTime)
@@ -407,35 +1339,127 @@ class MarketDataManager(object):
         self.agent            = agent
         self.config           = None
         self.barDataDict      = None
+        self.childIndex       = None     # Parent ID to IDs of shadow and resampled bar data.
+        self.tickBarIndex     = None     # Contract ID to tick bar data fed by its ticker.
         self.fxData           = None
         self.activeStatusData = None
         self.updateStatusData = None
         self.readyStatusData  = None
         self.pxLastData       = None
+        self.panelData        = None
+        self.barCache         = None
         self.configMarketData = None
         self.configShadowData = None
+        self.configResampled  = None
+        self.configTickBar    = None
+        self.configPanelData  = None
         self.configFxPairFile = None
+        self.configBarCache   = None
+        self.configMaxReq     = None
+        self.configFxTimeOut  = None
+        self.configGapMax     = None
+        self.configBarsMaxLen = None
 
     # ------------------------------------- Basic Functions -------------------------------------
 
     @Logger('main', 'debug')
-    def createBarData(self, id_, contract, para, option, startDate=None, updateFunc=None, dfBase=None, maxLen=100000, requestor=None):
-        requestor   = BarDataRequestor(self.ib) if requestor is None else requestor
+    def createBarData(self, id_, contract, para, option, startDate=None, updateFunc=None, dfBase=None, maxLen=100000, requestor=None, storage=None):
+        return ibi.util.run(self.createBarDataAsync(id_, contract, para, option, startDate, updateFunc, dfBase, maxLen, requestor, storage))
+
+    @Logger('main', 'debug')
+    async def createBarDataAsync(self, id_, contract, para, option, startDate=None, updateFunc=None, dfBase=None, maxLen=100000, requestor=None, storage=None):
+        requestor   = BarDataRequestor(self.ib, self.agent.RequestManager, self.barCache) if requestor is None else requestor
         currentTime = self.agent.currentTime
 
         self.validatePara(para)
-        barData = requestor.createBarData(id_, contract, para, option, currentTime, startDate, updateFunc, dfBase, maxLen)
+        barData = await requestor.createBarDataAsync(id_, contract, para, option, currentTime, startDate, updateFunc, dfBase, maxLen, storage)
+        barData.setGapTracking(self.configGapMax)
+        barData.setRetention(self.configBarsMaxLen)
+        if (self.agent.mode == 'backtest') and (option in [1, 2]):
+            barData.setPolling()
+        self.subscribeBarData(barData)
 
         return barData
 
+    @Logger('main', 'debug')
+    async def createBarDataFromConfigAsync(self, val, requestor):
+        id_        = val['custom_id']
+        contract   = self.agent.ContractManager.getContract(val['contract_id'])
+        para       = val['para']
+        option     = val['option']
+        maxLen     = val['max_len']
+        startDate  = val['start_date']
+        updateFunc = val['update_func']
+        dfBase     = val['df_base']
+        storage    = val['storage']
+
+        barData = await self.createBarDataAsync(id_, contract, para, option, startDate, updateFunc, dfBase, maxLen, requestor, storage)
+
+        mainLogger.debug(f'Initialized bar data for {contract.localSymbol}')
+
+        return barData
+
+    @Logger('main', 'debug')
+    def subscribeBarData(self, barData):
+        if (barData.barsR is not None) and (barData.isStreaming is False):
+            barData.barsR.updateEvent += barData.onBarUpdate
+            barData.isStreaming = True
+
+    @Logger('main', 'debug')
+    def unsubscribeBarData(self, barData):
+        if (barData.barsR is not None) and (barData.isStreaming is True):
+            barData.barsR.updateEvent -= barData.onBarUpdate
+            barData.isStreaming = False
+
     @Logger('main', 'debug')
     def createBarDataShadow(self, shadowId, contract, marketDataId):
 
-        shadowData = copy(self.barDataDict[marketDataId])
-        shadowData.contract = contract
-        shadowData.isShadow = True
+        shadowData = BarDataShadow(shadowId, contract, self.barDataDict[marketDataId])
 
         self.barDataDict[shadowId] = shadowData
+        self.childIndex.setdefault(marketDataId, list()).append(shadowId)
+
+    @Logger('main', 'debug')
+    def createResampledBarData(self, id_, marketDataId, barSize, maxLen=100000):
+        barData = ResampledBarData(id_, self.barDataDict[marketDataId], mapBarSize(barSize), maxLen)
+        barData.update(self.agent.currentTime, isInitializing=True)
+
+        self.barDataDict[id_] = barData
+        self.childIndex.setdefault(marketDataId, list()).append(id_)
+
+        return barData
+
+    @Logger('main', 'debug')
+    def relinkChildBarData(self, marketDataId):
+        for childId in self.childIndex.get(marketDataId, list()):
+            self.barDataDict[childId].parent = self.barDataDict[marketDataId]
+
+    @Logger('main', 'debug')
+    async def createTickBarDataAsync(self, id_, contract, barSize, maxLen=100000):
+        barData = TickBarData(id_, contract, mapBarSize(barSize), maxLen)
+        users   = self.tickBarIndex.setdefault(contract.conId, list())
+
+        # Share a ticker already streaming for the contract, from another tick bar data or from FxData.
+        if len(users) > 0:
+            barData.ticker, barData.isOwnTicker = users[0].ticker, users[0].isOwnTicker
+        else:
+            barData.ticker      = self.fxData.getTicker(contract.conId) if self.fxData is not None else None
+            barData.isOwnTicker = barData.ticker is None
+            if barData.isOwnTicker:
+                barData.ticker = await self.agent.RequestManager.reqMktDataAsync(contract, 'init', snapshot=False)
+        users.append(barData)
+
+        barData.update(self.agent.currentTime, isInitializing=True)
+        self.barDataDict[id_] = barData
+
+        return barData
+
+    # @Logger('main', 'debug')
+    def onPendingTickers(self, tickers):
+        for ticker in tickers:
+            for barData in self.tickBarIndex.get(ticker.contract.conId, ()):
+                if barData.ticker is ticker:
+                    barData.onTicker(ticker)
 
     @Logger('main', 'debug')
     def validatePara(self, para):
@@ -449,6 +1473,7 @@ class MarketDataManager(object):
     @Logger('main', 'info')
     def initialize(self, config):
         self.initializeConfig(config)
+        self.initializeBarCache()
         self.initializeAllData()
 
     @Logger('main', 'debug')
@@ -457,35 +1482,46 @@ class MarketDataManager(object):
         self.configMarketData = config['MARKET_DATA']
         self.configFxPairFile = config['FX_PAIRS_FILE']
         self.configShadowData = config['SHADOW_DATA']
+        self.configResampled  = config['RESAMPLED_DATA']
+        self.configTickBar    = config['TICK_BAR_DATA']
+        self.configPanelData  = config['PANEL_DATA']
+        self.configBarCache   = config['BAR_CACHE_DIR']
+        self.configMaxReq     = config['MAX_CONCURRENT_REQUESTS']
+        self.configFxTimeOut  = config['FX_READY_TIMEOUT']
+        self.configGapMax     = mapBarSize(config['GAP_MAX_DURATION']) if config['GAP_MAX_DURATION'] is not None else None
+        self.configBarsMaxLen = config['RAW_BARS_MAX_LEN']
+
+    @Logger('main', 'debug')
+    def initializeBarCache(self):
+        if self.configBarCache is not None:
+            self.barCache = BarCache(self.configBarCache)
 
     @Logger('main', 'debug')
     def initializeAllData(self):
         self.initializeBarData()
         self.initializeBarDataShadow()
+        self.initializeResampledBarData()
         self.initializeFxData()
+        self.initializeTickBarData()
         self.initializeActiveStatusData()
         self.initializeUpdateStatusData()
         self.initializeReadyStatusData()
         self.initializePxLastData()
+        self.initializePanelData()
 
     @Logger('main', 'debug')
     def initializeBarData(self):
-        self.barDataDict = dict()
-        requestor = BarDataRequestor(self.ib)
-        for key, val in self.configMarketData.items():
-
-            id_        = val['custom_id']
-            contract   = self.agent.ContractManager.getContract(val['contract_id'])
-            para       = val['para']
-            option     = val['option']
-            maxLen     = val['max_len']
-            startDate  = val['start_date']
-            updateFunc = val['update_func']
-            dfBase     = val['df_base']
+        ibi.util.run(self.initializeBarDataAsync())
 
-            self.barDataDict[id_] = self.createBarData(id_, contract, para, option, startDate, updateFunc, dfBase, maxLen, requestor)
+    @Logger('main', 'debug')
+    async def initializeBarDataAsync(self):
+        # Request all series at once, bounded by the number of concurrent historical data requests.
+        requestor   = BarDataRequestor(self.ib, self.agent.RequestManager, self.barCache)
+        coros       = [self.createBarDataFromConfigAsync(val, requestor) for val in self.configMarketData.values()]
+        barDataList = await gather_with_limit(coros, self.configMaxReq)
 
-            mainLogger.debug(f'Initialized bar data for {contract.localSymbol}')
+        self.barDataDict = {barData.id: barData for barData in barDataList}
+        self.childIndex  = dict()
 
     @Logger('main', 'debug')
     def initializeBarDataShadow(self):
@@ -498,15 +1534,46 @@ class MarketDataManager(object):
 
             mainLogger.debug(f'Initialized bar data for {contract.localSymbol}')
 
+    @Logger('main', 'debug')
+    def initializeResampledBarData(self):
+        # Sources are created first, so resampled bars are updated after their parents in barDataDict order.
+        for id_, val in self.configResampled.items():
+            barData = self.createResampledBarData(id_, val['market_data_id'], val['bar_size'], val['max_len'])
+
+            mainLogger.debug(f'Initialized resampled bar data {id_} for {barData.contract.localSymbol}')
+
+    @Logger('main', 'debug')
+    def initializeTickBarData(self):
+        ibi.util.run(self.initializeTickBarDataAsync())
+
+    @Logger('main', 'debug')
+    async def initializeTickBarDataAsync(self):
+        # After FxData, so FX pairs reuse its tickers.
+        self.tickBarIndex = dict()
+        for id_, val in self.configTickBar.items():
+            contract = self.agent.ContractManager.getContract(val['contract_id'])
+            await self.createTickBarDataAsync(id_, contract, val['bar_size'], val['max_len'])
+
+            mainLogger.debug(f'Initialized tick bar data {id_} for {contract.localSymbol}')
+
+        if len(self.tickBarIndex) > 0:
+            self.ib.pendingTickersEvent += self.onPendingTickers
+
     @Logger('main', 'debug')
     def initializeFxData(self):
         baseCcy  = self.agent.baseCcy
         filePath = self.configFxPairFile
 
-        fxData   = FxData(self.ib, baseCcy, filePath, updateTimeOut=0)
-        fxData.set()
+        fxData   = FxData(self.ib, self.agent.RequestManager, baseCcy, filePath, self.configFxTimeOut)
+        fxData.set(self.getRequiredCcys())
         self.fxData = fxData
 
+    @Logger('main', 'debug')
+    def getRequiredCcys(self):
+        # Currencies of the configured contracts and of current positions, startup waits only for these.
+        contracts = self.agent.ContractManager.getAllContracts() + [position.contract for position in self.ib.positions()]
+        return list({contract.currency for contract in contracts})
+
     @Logger('main', 'debug')
     def initializeActiveStatusData(self):
         ids         = list(self.barDataDict.keys())
@@ -560,31 +1627,119 @@ class MarketDataManager(object):
         self.pxLastData = PxLastData()
         self.pxLastData.set(contracts, ids, closes, lastDateBars, updateTimes)
 
+    @Logger('main', 'debug')
+    def initializePanelData(self):
+        if self.configPanelData is not None:
+            self.panelData = BarPanel(self.configPanelData['max_len'], self.configPanelData['fields'])
+            self.panelData.set(self.configPanelData['market_data_ids'], self.barDataDict)
+
+    @Logger('main', 'debug')
+    def requirePanelData(self, ids, fields, maxLen):
+        # Strategies on several series read the panel of the manager instead of keeping their own. Series and fields
+        # the panel lacks, configured or not, are added by building it again over the union, so every reader keeps
+        # being served. Returns the panel column of each id, a shadow reads its parent's column.
+        panel     = self.panelData
+        oldIds    = list() if panel is None else panel.ids
+        oldFields = list() if panel is None else list(panel.fields)
+        newIds    = [self.getRootId(id_) for id_ in ids if (panel is None) or (self.getPanelIdx(id_) is None)]
+        newIds    = [id_ for id_ in dict.fromkeys(newIds) if id_ not in oldIds]
+        newFields = [field for field in fields if field not in oldFields]
+
+        if (panel is None) or (len(newIds) > 0) or (len(newFields) > 0):
+            self.panelData = BarPanel(max(maxLen, 0 if panel is None else panel.maxLen), oldFields + newFields)
+            self.panelData.set(oldIds + newIds, self.barDataDict)
+
+            mainLogger.debug(f'Panel data extended with series {newIds} and fields {newFields}')
+
+        return np.array([self.getPanelIdx(id_) for id_ in ids], dtype=np.int64)
+
+    @Logger('main', 'debug')
+    def getRootId(self, id_):
+        # Id of the bar data a shadow reads from.
+        barData = self.barDataDict[id_]
+        while barData.isShadow and (barData.parent is not None):
+            barData = barData.parent
+        return barData.id
+
+    @Logger('main', 'debug')
+    def getPanelIdx(self, id_):
+        barData = self.barDataDict[id_]
+        while (id_ not in self.panelData.idIdx) and barData.isShadow and (barData.parent is not None):
+            barData = barData.parent
+            id_     = barData.id
+        return self.panelData.idIdx.get(id_)
+
     # ------------------------------------- Update -------------------------------------
 
     @Logger('main', 'info')
     def update(self):
+        self.updateBarDataGaps()
+        self.pollBarData()
         self.updateBarData()
         self.updateFxData()
         self.updateActiveStatusData()
         self.updateUpdateStatusData()
         self.updateReadyStatusData()
         self.updatePxLastData()
+        self.updatePanelData()
 
     @Logger('main', 'debug')
     def updateBarData(self):
         currentTime  = self.agent.currentTime
         ids          = list(self.barDataDict.keys())
         idsNonShadow = [id_ for id_ in ids if self.barDataDict[id_].isShadow is False]
-        idsShadow    = [id_ for id_ in ids if self.barDataDict[id_].isShadow is True]
 
+        # Shadows read through to their parents and need no update.
         for id_ in idsNonShadow:
             self.barDataDict[id_].update(currentTime)
 
-        for id_ in idsShadow:
-            parentId = self.barDataDict[id_].id
-            parentBarData = self.barDataDict[parentId]
-            self.barDataDict[id_].update(currentTime, parentBarData)
+    @Logger('main', 'debug')
+    def updateBarDataGaps(self):
+        ids = [id_ for id_, barData in self.barDataDict.items() if (barData.isShadow is False) and (len(barData.gaps) > 0)]
+        if len(ids) > 0:
+            ibi.util.run(self.updateBarDataGapsAsync(ids))
+
+    @Logger('main', 'debug')
+    async def updateBarDataGapsAsync(self, ids):
+        requestor = BarDataRequestor(self.ib, self.agent.RequestManager, self.barCache)
+        await asyncio.gather(*[self.backfillBarDataAsync(id_, requestor) for id_ in ids])
+
+    @Logger('main', 'debug')
+    async def backfillBarDataAsync(self, id_, requestor):
+        # One request per gap, a gap IB has no bars for is kept as a session break and not recorded again.
+        barData = self.barDataDict[id_]
+        para    = self.configMarketData[id_]['para']
+        gaps    = list(barData.gaps.items())
+        barData.gaps.clear()
+
+        for startNs, endNs in gaps:
+            startDate = barData.store.toTimestamp(startNs)
+            endDate   = barData.store.toTimestamp(endNs)
+            bars      = await requestor.reqBarsBetweenAsync(barData.contract, para, startDate, endDate)
+            if len(bars) == 0:
+                barData.addBreak(startNs, endNs)
+            barData.mergeBars(bars)
+
+            mainLogger.debug(f'Backfilled {len(bars)} bars for {id_} from {startDate} to {endDate}')
+
+    @Logger('main', 'debug')
+    def pollBarData(self):
+        ids = [id_ for id_, barData in self.barDataDict.items() if (barData.isShadow is False) and barData.isPolled
+               and (barData.lastDateDf is not None)]
+        if len(ids) > 0:
+            ibi.util.run(self.pollBarDataAsync(ids))
+
+    @Logger('main', 'debug')
+    async def pollBarDataAsync(self, ids):
+        # Historical-only series, e.g. in backtests, take the bars since their last closed one each update.
+        requestor   = BarDataRequestor(self.ib, self.agent.RequestManager, self.barCache)
+        currentTime = self.agent.currentTime
+        barsList    = await asyncio.gather(*[requestor.reqBarsSinceAsync(self.barDataDict[id_].contract,
+                                                                         self.configMarketData[id_]['para'],
+                                                                         self.barDataDict[id_].lastDateDf,
+                                                                         currentTime) for id_ in ids])
+        for id_, bars in zip(ids, barsList):
+            self.barDataDict[id_].pollBars(bars)
 
     @Logger('main', 'debug')
     def updateFxData(self):
@@ -592,33 +1747,43 @@ class MarketDataManager(object):
 
     @Logger('main', 'debug')
     def updateActiveStatusData(self):
-        for id_ in self.barDataDict.keys():
-            status = self.barDataDict[id_].isActive
-            updateTime = self.barDataDict[id_].updateTime['isActive']
-            self.activeStatusData.update(id_, status, updateTime)
+        barDataList = self.getStatusDataOrder(self.activeStatusData)
+        status      = [barData.isActive for barData in barDataList]
+        updateTimes = [barData.updateTime['isActive'] for barData in barDataList]
+        self.activeStatusData.update(self.activeStatusData.ids, status, updateTimes)
 
     @Logger('main', 'debug')
     def updateUpdateStatusData(self):
-        for id_ in self.barDataDict.keys():
-            status = self.barDataDict[id_].isUpdated
-            updateTime = self.barDataDict[id_].updateTime['isUpdated']
-            self.updateStatusData.update(id_, status, updateTime)
+        barDataList = self.getStatusDataOrder(self.updateStatusData)
+        status      = [barData.isUpdated for barData in barDataList]
+        updateTimes = [barData.updateTime['isUpdated'] for barData in barDataList]
+        self.updateStatusData.update(self.updateStatusData.ids, status, updateTimes)
 
     @Logger('main', 'debug')
     def updateReadyStatusData(self):
-        for id_ in self.barDataDict.keys():
-            status = self.barDataDict[id_].isReady
-            updateTime = self.barDataDict[id_].updateTime['isReady']
-            self.readyStatusData.update(id_, status, updateTime)
+        barDataList = self.getStatusDataOrder(self.readyStatusData)
+        status      = [barData.isReady for barData in barDataList]
+        updateTimes = [barData.updateTime['isReady'] for barData in barDataList]
+        self.readyStatusData.update(self.readyStatusData.ids, status, updateTimes)
 
     @Logger('main', 'debug')
     def updatePxLastData(self):
-        for id_ in self.barDataDict.keys():
-            pxLast       = self.barDataDict[id_].pxLast
-            close        = pxLast.close if pxLast is not None else np.nan
-            lastDateBars = pxLast.date  if pxLast is not None else pd.NaT
-            updateTime   = self.barDataDict[id_].updateTime['pxLast']
-            self.pxLastData.update(id_, close, lastDateBars, updateTime)
+        barDataList  = self.getStatusDataOrder(self.pxLastData)
+        pxLasts      = [barData.pxLast for barData in barDataList]
+        closes       = [pxLast.close if pxLast is not None else np.nan for pxLast in pxLasts]
+        lastDateBars = [pxLast.date  if pxLast is not None else pd.NaT for pxLast in pxLasts]
+        updateTimes  = [barData.updateTime['pxLast'] for barData in barDataList]
+        self.pxLastData.update(self.pxLastData.ids, closes, lastDateBars, updateTimes)
+
+    @Logger('main', 'debug')
+    def updatePanelData(self):
+        if self.panelData is not None:
+            self.panelData.update(self.barDataDict)
+
+    @Logger('main', 'debug')
+    def getStatusDataOrder(self, data):
+        # Bar data in the row order of a status table, so each table is written in one pass.
+        return [self.barDataDict[id_] for id_ in data.ids]
 
     # ------------------------------------- Cancel -------------------------------------
 
@@ -629,14 +1794,29 @@ class MarketDataManager(object):
 
     @Logger('main', 'debug')
     def cancelBarDataRequest(self, id_):
-        if self.barDataDict[id_].barsR is not None and self.barDataDict[id_].isShadow is False:
+        if isinstance(self.barDataDict[id_], TickBarData):
+            self.cancelTickBarDataRequest(self.barDataDict[id_])
+        elif self.barDataDict[id_].barsR is not None and self.barDataDict[id_].isShadow is False:
+            self.unsubscribeBarData(self.barDataDict[id_])
             self.ib.cancelHistoricalData(self.barDataDict[id_].barsR)
 
     @Logger('main', 'debug')
     def cancelAllBarDataRequest(self):
+        self.ib.pendingTickersEvent -= self.onPendingTickers
         for id_ in self.barDataDict.keys():
             self.cancelBarDataRequest(id_)
 
+    @Logger('main', 'debug')
+    def cancelTickBarDataRequest(self, barData):
+        # The ticker is cancelled with its last user, unless it belongs to FxData.
+        users = self.tickBarIndex.get(barData.contract.conId, list())
+        if barData in users:
+            users.remove(barData)
+            if len(users) == 0:
+                del self.tickBarIndex[barData.contract.conId]
+                if barData.isOwnTicker:
+                    self.ib.cancelMktData(barData.ticker.contract)
+
     @Logger('main', 'debug')
     def cancelFxDataRequest(self, contract):
         self.ib.cancelMktData(contract)
@@ -644,9 +1824,61 @@ class MarketDataManager(object):
     @Logger('main', 'debug')
     def cancelAllFxDataRequest(self):
         if self.fxData is not None:
+            self.ib.pendingTickersEvent -= self.fxData.onPendingTickers
             for contract in self.fxData.df['contract']:
                 self.cancelFxDataRequest(contract)
 
+    # ------------------------------------- Resubscribe -------------------------------------
+
+    @Logger('main', 'info')
+    def resubscribeAllData(self):
+        self.resubscribeAllBarData()
+
+    @Logger('main', 'debug')
+    def resubscribeAllBarData(self):
+        ibi.util.run(self.resubscribeAllBarDataAsync(self.ib.reqCurrentTime()))
+
+    @Logger('main', 'debug')
+    async def resubscribeAllBarDataAsync(self, currentTime):
+        # Only streaming series lost their subscription, stores, status tables and strategies are kept as they are.
+        requestor = BarDataRequestor(self.ib, self.agent.RequestManager, self.barCache)
+        ids       = [id_ for id_, barData in self.barDataDict.items() if (barData.isShadow is False) and (barData.barsR is not None)]
+        coros     = [self.resubscribeBarDataAsync(id_, requestor, currentTime) for id_ in ids]
+        await gather_with_limit(coros, self.configMaxReq)
+
+    @Logger('main', 'debug')
+    async def resubscribeBarDataAsync(self, id_, requestor, currentTime):
+        barData = self.barDataDict[id_]
+        val     = self.configMarketData[id_]
+        self.cancelBarDataRequest(id_)
+
+        # One bar size of overlap, the last bar received before the interruption may have been incomplete.
+        startDate = barData.lastDateBars - barData.barSize if barData.lastDateBars is not None else None
+        bars      = await requestor.reqStreamingBarsSinceAsync(barData.contract, val['para'], startDate, currentTime)
+        if val['update_func'] is not None:
+            bars.updateEvent += val['update_func']
+
+        barData.setBars('r', bars)
+        barData.updateBarsToDf(bars)
+        barData.trimBars()
+        self.subscribeBarData(barData)
+
+        mainLogger.debug(f'Resubscribed bar data for {barData.contract.localSymbol} with {len(bars)} bars since {startDate}')
+
+    # ------------------------------------- Cache -------------------------------------
+
+    @Logger('main', 'debug')
+    def saveBarDataCache(self, id_):
+        barData = self.barDataDict[id_]
+        if (self.barCache is not None) and (barData.isShadow is False) and (barData.option in [2, 4]):
+            self.barCache.save(barData.contract, self.configMarketData[id_]['para'], barData.store)
+
+    @Logger('main', 'debug')
+    def saveAllBarDataCache(self):
+        if self.barDataDict is not None:
+            for id_ in self.barDataDict.keys():
+                self.saveBarDataCache(id_)
+
     # ------------------------------------- Drop -------------------------------------
 
     @Logger('main', 'info')
@@ -657,9 +1889,17 @@ class MarketDataManager(object):
         self.dropAllUpdateStatusData()
         self.dropAllReadyStatusData()
         self.dropAllPxLastData()
+        self.dropAllPanelData()
 
     @Logger('main', 'debug')
     def dropBarData(self, id_):
+        barData = self.barDataDict[id_]
+        if barData.parent is not None:
+            self.childIndex[barData.parent.id].remove(id_)
+        for childId in list(self.childIndex.get(id_, list())):
+            self.dropBarData(childId)
+        self.childIndex.pop(id_, None)
+
         self.cancelBarDataRequest(id_)
         del self.barDataDict[id_]
 
@@ -667,16 +1907,21 @@ class MarketDataManager(object):
         self.dropUpdateStatusData(id_)
         self.dropReadyStatusData(id_)
         self.dropPxLastData(id_)
+        self.dropPanelData(id_)
 
     @Logger('main', 'debug')
     def dropAllBarData(self):
+        self.saveAllBarDataCache()
         self.cancelAllBarDataRequest()
-        self.barDataDict = None
+        self.barDataDict  = None
+        self.childIndex   = None
+        self.tickBarIndex = None
 
         self.dropAllActiveStatusData()
         self.dropAllUpdateStatusData()
         self.dropAllReadyStatusData()
         self.dropAllPxLastData()
+        self.dropAllPanelData()
 
     @Logger('main', 'debug')
     def dropFxData(self, contract):
@@ -720,6 +1965,15 @@ class MarketDataManager(object):
     def dropAllPxLastData(self):
         self.pxLastData = None
 
+    @Logger('main', 'debug')
+    def dropPanelData(self, id_):
+        if self.panelData is not None:
+            self.panelData.drop(id_)
+
+    @Logger('main', 'debug')
+    def dropAllPanelData(self):
+        self.panelData = None
+
     # ------------------------------------- Reset -------------------------------------
 
     @Logger('main', 'info')
@@ -730,7 +1984,7 @@ class MarketDataManager(object):
     @Logger('main', 'debug')
     def resetBarData(self, id_):
         self.cancelBarDataRequest(id_)
-        requestor  = BarDataRequestor(self.ib)
+        requestor  = BarDataRequestor(self.ib, self.agent.RequestManager, self.barCache)
 
         val        = self.configMarketData[id_]
         id_        = val['custom_id']
@@ -740,19 +1994,24 @@ class MarketDataManager(object):
         maxLen     = val['max_len']
         startDate  = val['start_date']
         updateFunc = val['update_func']
+        storage    = val['storage']
         dfBase     = self.barDataDict[id_].df    # Inherit existing df.
 
-        self.barDataDict[id_] = self.createBarData(id_, contract, para, option, startDate, updateFunc, dfBase, maxLen, requestor)
+        self.barDataDict[id_] = self.createBarData(id_, contract, para, option, startDate, updateFunc, dfBase, maxLen, requestor, storage)
+        self.relinkChildBarData(id_)
 
     @Logger('main', 'debug')
     def resetAllBarData(self):
         self.dropAllBarData()
         self.initializeBarData()
         self.initializeBarDataShadow()
+        self.initializeResampledBarData()
+        self.initializeTickBarData()
         self.initializeActiveStatusData()
         self.initializeUpdateStatusData()
         self.initializeReadyStatusData()
         self.initializePxLastData()
+        self.initializePanelData()
 
     @Logger('main', 'debug')
     def resetAllFxData(self):
@@ -0,0 +1,253 @@
+import asyncio
+import heapq
+import itertools
+import pandas as pd
+import ib_insync as ibi
+from copy import copy
+from src.util.log_util import *
+
+
+class RequestLane(object):
+
+    # Token bucket with a cap on requests in flight. Waiters are released by priority, then by arrival.
+
+    @Logger('main', 'info')
+    def __init__(self, laneId, capacity, rate, maxConcurrent=None):
+        self.id            = laneId
+        self.capacity      = capacity
+        self.rate          = rate       # Tokens per second.
+        self.maxConcurrent = maxConcurrent
+        self.tokens        = capacity
+        self.lastRefill    = None
+        self.inFlight      = 0
+        self.waiters       = list()
+        self.counter       = itertools.count()
+        self.timer         = None
+        self.nRequests     = 0
+        self.nDeduplicated = 0
+        self.totalWait     = 0.
+        self.maxWait       = 0.
+
+    # ------------------------------------- Basic Functions -------------------------------------
+
+    @property
+    def queueDepth(self):
+        return len(self.waiters)
+
+    def refill(self, now):
+        if self.lastRefill is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.lastRefill) * self.rate)
+        self.lastRefill = now
+
+    def isAvailable(self):
+        isUnderCap = (self.maxConcurrent is None) or (self.inFlight < self.maxConcurrent)
+        return isUnderCap and (self.tokens >= 1)
+
+    async def acquire(self, priority):
+        loop   = ibi.util.getLoop()
+        future = loop.create_future()
+        start  = loop.time()
+        heapq.heappush(self.waiters, (priority, next(self.counter), future))
+        self.dispatch()
+        await future
+
+        wait = loop.time() - start
+        self.nRequests += 1
+        self.totalWait += wait
+        self.maxWait    = max(self.maxWait, wait)
+
+    def release(self):
+        self.inFlight -= 1
+        self.dispatch()
+
+    def dispatch(self):
+        loop = ibi.util.getLoop()
+        self.refill(loop.time())
+        while (len(self.waiters) > 0) and self.isAvailable():
+            _, _, future = heapq.heappop(self.waiters)
+            if future.cancelled():
+                continue
+            self.tokens   -= 1
+            self.inFlight += 1
+            future.set_result(None)
+
+        # Wake up again once the next token is due, a concurrency slot is woken up by release instead.
+        if (len(self.waiters) > 0) and (self.tokens < 1) and (self.timer is None):
+            self.timer = loop.call_later((1 - self.tokens) / self.rate, self.onTimer)
+
+    def onTimer(self):
+        self.timer = None
+        self.dispatch()
+
+    def getMetrics(self):
+        return {'lane'          : self.id,
+                'queue_depth'   : self.queueDepth,
+                'in_flight'     : self.inFlight,
+                'tokens'        : self.tokens,
+                'requests'      : self.nRequests,
+                'deduplicated'  : self.nDeduplicated,
+                'avg_wait'      : self.totalWait / self.nRequests if self.nRequests > 0 else 0.,
+                'max_wait'      : self.maxWait}
+
+
+class RequestManager(object):
+
+    # Priority classes, lower is served first.
+    priorities = {
+        'live'    : 0,
+        'init'    : 1,
+        'backfill': 2,
+    }
+
+    @Logger('main', 'info')
+    def __init__(self, agent):
+        self.ib       = agent.ib
+        self.agent    = agent
+        self.config   = None
+        self.lanes    = None
+        self.pending  = None
+        self.recent   = None
+        self.cooldown = None
+
+    # ------------------------------------- Basic Functions -------------------------------------
+
+    @Logger('main', 'debug')
+    async def schedule(self, laneId, func, *args, priority='live', key=None, **kwargs):
+        # Run an IB request once its lane allows it. Identical requests in flight or within the cooldown share
+        # one result. The shared result is kept untouched, every caller gets its own copy to extend or trim.
+        lane = self.lanes[laneId]
+
+        if key is not None:
+            now = ibi.util.getLoop().time()
+            if (key in self.recent) and (now - self.recent[key][0] < self.cooldown):
+                lane.nDeduplicated += 1
+                return copy(self.recent[key][1])
+            if key in self.pending:
+                lane.nDeduplicated += 1
+                return copy(await asyncio.shield(self.pending[key]))
+
+        task = asyncio.ensure_future(self.run(lane, func, args, kwargs, self.priorities[priority]))
+        if key is not None:
+            self.pending[key] = task
+            try:
+                result = await task
+                self.recent[key] = (ibi.util.getLoop().time(), result)
+            finally:
+                del self.pending[key]
+            return copy(result)
+
+        return await task
+
+    @Logger('main', 'debug')
+    async def run(self, lane, func, args, kwargs, priority):
+        await lane.acquire(priority)
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            lane.release()
+
+    @Logger('main', 'debug')
+    def getMetricsDf(self):
+        return pd.DataFrame([lane.getMetrics() for lane in self.lanes.values()])
+
+    @staticmethod
+    def getHistoricalDataKey(contract, para):
+        # Streaming requests are never shared since each subscriber owns and cancels its own bar list.
+        if para.get('keepUpToDate', False):
+            return None
+        return ('hist', contract.conId) + tuple((k, str(para[k])) for k in sorted(para.keys()))
+
+    # ------------------------------------- Requests -------------------------------------
+
+    @Logger('main', 'debug')
+    async def reqHistoricalDataAsync(self, contract, priority='live', **para):
+        key = self.getHistoricalDataKey(contract, para)
+        return await self.schedule('hist', self.ib.reqHistoricalDataAsync, contract, priority=priority, key=key, **para)
+
+    @Logger('main', 'debug')
+    def reqHistoricalData(self, contract, priority='live', **para):
+        return ibi.util.run(self.reqHistoricalDataAsync(contract, priority, **para))
+
+    @Logger('main', 'debug')
+    async def qualifyContractsAsync(self, *contracts, priority='init'):
+        return await self.schedule('contract', self.ib.qualifyContractsAsync, *contracts, priority=priority)
+
+    @Logger('main', 'debug')
+    def qualifyContracts(self, *contracts, priority='init'):
+        return ibi.util.run(self.qualifyContractsAsync(*contracts, priority=priority))
+
+    @Logger('main', 'debug')
+    async def reqContractDetailsAsync(self, contract, priority='init'):
+        key = ('details', repr(contract))
+        return await self.schedule('contract', self.ib.reqContractDetailsAsync, contract, priority=priority, key=key)
+
+    @Logger('main', 'debug')
+    def reqContractDetails(self, contract, priority='init'):
+        return ibi.util.run(self.reqContractDetailsAsync(contract, priority))
+
+    @Logger('main', 'debug')
+    async def reqMktDataAsync(self, contract, priority='live', **para):
+        async def reqMktData():
+            return self.ib.reqMktData(contract, **para)
+        return await self.schedule('mkt', reqMktData, priority=priority)
+
+    @Logger('main', 'debug')
+    def reqMktData(self, contract, priority='live', **para):
+        return ibi.util.run(self.reqMktDataAsync(contract, priority, **para))
+
+    # ------------------------------------- Initialize -------------------------------------
+
+    @Logger('main', 'info')
+    def initialize(self, config):
+        self.initializeConfig(config)
+        self.initializeLanes()
+
+    @Logger('main', 'debug')
+    def initializeConfig(self, config):
+        self.config   = config
+        self.cooldown = config['HIST_IDENTICAL_COOLDOWN'] if self.agent.mode != 'backtest' else 0
+
+    @Logger('main', 'debug')
+    def initializeLanes(self):
+        histCapacity = self.config['HIST_MAX_REQUESTS']
+        histRate     = histCapacity / self.config['HIST_PACING_WINDOW']
+        msgRate      = self.config['MSG_MAX_RATE']
+
+        # The simulated broker has no pacing, and the lanes run on the real loop time rather than its clock.
+        if self.agent.mode == 'backtest':
+            histCapacity = histRate = msgRate = float('inf')
+
+        self.lanes = {
+            'hist'    : RequestLane('hist', histCapacity, histRate, self.config['HIST_MAX_CONCURRENT']),
+            'mkt'     : RequestLane('mkt', msgRate, msgRate),
+            'contract': RequestLane('contract', msgRate, msgRate),
+        }
+        self.pending = dict()
+        self.recent  = dict()
+
+    # ------------------------------------- Update -------------------------------------
+
+    @Logger('main', 'info')
+    def update(self):
+        self.updateRecent()
+        self.logMetrics()
+
+    @Logger('main', 'debug')
+    def updateRecent(self):
+        # Results past the identical-request cooldown are not served again.
+        now = ibi.util.getLoop().time()
+        for key in [key for key, (t, _) in self.recent.items() if now - t >= self.cooldown]:
+            del self.recent[key]
+
+    @Logger('main', 'debug')
+    def logMetrics(self):
+        for lane in self.lanes.values():
+            metrics = lane.getMetrics()
+            mainLogger.debug(f'Request lane {lane.id} - queue:{metrics["queue_depth"]} - inFlight:{metrics["in_flight"]} - '
+                             f'requests:{metrics["requests"]} - deduplicated:{metrics["deduplicated"]} - '
+                             f'avgWait:{metrics["avg_wait"]:.2f}s - maxWait:{metrics["max_wait"]:.2f}s')
+
+
+if __name__ == '__main__':
+
+    pass
@@ -0,0 +1,152 @@
+import itertools
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from src.manager.Backtest import fillActions, summarizePnls
+from src.util.log_util import *
+
+
+FIELDS = ['open', 'high', 'low', 'close']
+
+
+def evaluateSliceNp(bars, strategyClass, configs, trainStart, testStart, testEnd, objective, quantity, commission):
+    # Score every config on the train bars, then replay the best one from the train start so its state is warm when
+    # the test bars begin. Only the actions on the test bars are returned, they are filled once stitched.
+    open_, high, low, close = bars[:, trainStart:testEnd]
+    nTrain = testStart - trainStart
+
+    scores = list()
+    for config in configs:
+        actions           = strategyClass.getActionsNp(config, close[:nTrain], high[:nTrain], low[:nTrain])
+        held, costs, pnls = fillActions(actions, open_[:nTrain], close[:nTrain], quantity, commission)
+        scores.append(summarizePnls(actions, held, costs, pnls)[objective])
+    scores = np.array(scores, dtype=float)
+    best   = int(np.nanargmax(scores)) if not np.all(np.isnan(scores)) else 0
+
+    actions = strategyClass.getActionsNp(configs[best], close, high, low)
+    return best, float(scores[best]), actions[nTrain:]
+
+
+def evaluateSlice(shmName, shape, strategyClass, configs, trainStart, testStart, testEnd, objective, quantity, commission):
+    # Process pool side, the bar arrays are read in place from the shared block instead of being pickled per task.
+    shm = shared_memory.SharedMemory(name=shmName)
+    try:
+        bars = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+        result = evaluateSliceNp(bars, strategyClass, configs, trainStart, testStart, testEnd, objective, quantity, commission)
+        del bars
+        return result
+    finally:
+        shm.close()
+
+
+class WalkForward(object):
+
+    # Rolling walk-forward of a SingleContractAndBarDataStrategy subclass over one bar history. Each train slice
+    # picks the grid point with the highest objective, the test slice after it is traded with that point, and the
+    # test slices together make the out-of-sample record. Slices are spread over a process pool.
+
+    @Logger('main', 'info')
+    def __init__(self, strategyClass, baseConfig, grid, trainPeriod, testPeriod, objective='sharpe', quantity=1,
+                 commission=0., maxWorkers=None, minTasksForPool=4):
+        self.strategyClass   = strategyClass
+        self.grid            = grid     # Config key to the values tried, e.g. {'WINDOW': [14, 28]}.
+        self.configs         = [dict(baseConfig, **dict(zip(grid.keys(), values))) for values in itertools.product(*grid.values())]
+        self.trainPeriod     = pd.Timedelta(trainPeriod)
+        self.testPeriod      = pd.Timedelta(testPeriod)
+        self.objective       = objective    # Key of summarizePnls, higher is better.
+        self.quantity        = quantity
+        self.commission      = commission
+        self.maxWorkers      = maxWorkers
+        self.minTasksForPool = minTasksForPool
+        self.report          = None
+        self.oos             = None
+
+    # ------------------------------------- Basic Functions -------------------------------------
+
+    @Logger('main', 'debug')
+    def getSlices(self, dates):
+        # (trainStart, testStart, testEnd) bar indices, the test slices follow each other without overlap.
+        trainNs = self.trainPeriod.value
+        testNs  = self.testPeriod.value
+        slices  = list()
+        t       = dates[0] + trainNs
+        while t <= dates[-1]:
+            trainStart, testStart, testEnd = np.searchsorted(dates, [t - trainNs, t, t + testNs]).tolist()
+            if (testEnd > testStart) and (testStart > trainStart):
+                slices.append((trainStart, testStart, testEnd))
+            t += testNs
+        return slices
+
+    @Logger('main', 'info')
+    def getSummary(self):
+        return summarizePnls(*[self.oos[col].to_numpy() for col in ['action', 'position', 'cost', 'pnl']])
+
+    # ------------------------------------- Run -------------------------------------
+
+    @Logger('main', 'info')
+    def run(self, df):
+        dates  = pd.to_datetime(df['date'], utc=True).values.astype('datetime64[ns]').astype('int64')
+        bars   = np.vstack([df[field].to_numpy(dtype=np.float64) for field in FIELDS])
+        slices = self.getSlices(dates)
+
+        shm = shared_memory.SharedMemory(create=True, size=bars.nbytes)
+        try:
+            shared    = np.ndarray(bars.shape, dtype=np.float64, buffer=shm.buf)
+            shared[:] = bars
+            del shared
+
+            tasks = [(shm.name, bars.shape, self.strategyClass, self.configs, *slice_, self.objective, self.quantity,
+                      self.commission) for slice_ in slices]
+            if (len(tasks) >= self.minTasksForPool) and (self.maxWorkers != 1):
+                with ProcessPoolExecutor(max_workers=self.maxWorkers) as executor:
+                    results = list(executor.map(evaluateSlice, *zip(*tasks)))
+            else:
+                results = [evaluateSlice(*task) for task in tasks]
+        finally:
+            shm.close()
+            shm.unlink()
+
+        self.setReport(df, bars, slices, results)
+
+        mainLogger.debug(f'Walk-forward of {self.strategyClass.__name__} over {len(slices)} slices and '
+                         f'{len(self.configs)} parameter sets')
+
+        return self.report
+
+    @Logger('main', 'debug')
+    def setReport(self, df, bars, slices, results):
+        # The test slices follow each other, so their actions are filled as one record. A position is carried over
+        # a slice boundary until the next slice's strategy trades, as it would be live.
+        idx               = np.concatenate([np.arange(testStart, testEnd) for _, testStart, testEnd in slices] + [np.array([], dtype=int)])
+        actions           = np.concatenate([result[2] for result in results] + [np.array([], dtype=np.int8)])
+        held, costs, pnls = fillActions(actions, bars[0, idx], bars[3, idx], self.quantity, self.commission)
+        test              = np.vstack([actions, held, costs, pnls])
+
+        dates = df['date'].reset_index(drop=True)
+        rows  = list()
+        pos   = 0
+        for (trainStart, testStart, testEnd), (best, score, _) in zip(slices, results):
+            end = pos + testEnd - testStart
+            row = {'train_start': dates.iloc[trainStart],
+                   'test_start' : dates.iloc[testStart],
+                   'test_end'   : dates.iloc[testEnd - 1]}
+            row.update({key: self.configs[best][key] for key in self.grid.keys()})
+            row['train_' + self.objective] = score
+            initialPosition = test[1, pos - 1] if pos > 0 else 0.
+            row.update({'test_' + key: val for key, val in summarizePnls(*test[:, pos:end], initialPosition).items()})
+            rows.append(row)
+            pos = end
+        self.report = pd.DataFrame(rows)
+
+        self.oos = pd.DataFrame({'date'    : dates.iloc[idx].reset_index(drop=True),
+                                 'action'  : test[0].astype(np.int8),
+                                 'position': test[1],
+                                 'cost'    : test[2],
+                                 'pnl'     : test[3],
+                                 'equity'  : np.cumsum(test[3])})
+
+
+if __name__ == '__main__':
+
+    pass
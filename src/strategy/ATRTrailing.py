@@ -1,9 +1,91 @@
 import pandas as pd
 import numpy as np
+from collections import deque
+from numba import njit
+from src.manager.Indicator import trueRangeNp
 from src.util.dt_util import isWithinPeriod
 from src.util.log_util import *
 
 
+# Integer codes of the side, breakout type and action states in the compiled kernel.
+SIDE_CODES     = {None: 0, 'up': 1, 'down': -1}
+BREAKOUT_CODES = {None: 0, 'resist': 1, 'support': 2, 'xLevelUp': 3, 'xLevelDown': 4}
+ACTION_CODES   = {None: 0, 'BUY': 1, 'SELL': -1}
+SIDE_NAMES     = {code: side for side, code in SIDE_CODES.items()}
+BREAKOUT_NAMES = {code: breakOut for breakOut, code in BREAKOUT_CODES.items()}
+ACTION_NAMES   = {code: action for action, code in ACTION_CODES.items()}
+
+
+@njit(cache=True)
+def atrTrailingKernel(close, atrs, start, side, xSide):
+    # Compiled replay of updateLevel, updateBreakout and updateAction over bars start to the end, levels are
+    # written at the bar index. Python max/min semantics are kept, so NaN levels propagate exactly as in the
+    # list-based path.
+    n         = len(close)
+    supports  = np.full(n, np.nan)
+    resists   = np.full(n, np.nan)
+    xLevels   = np.full(n, np.nan)
+    actions   = np.zeros(n, dtype=np.int8)
+    breakOut  = 0
+    support_1 = np.nan
+    resist_1  = np.nan
+    xLevel_1  = np.nan
+
+    for i in range(start, n):
+        close_1 = close[i - 1]
+        close_0 = close[i]
+        atr_0   = atrs[i]
+
+        if i == start:
+            support = close_1 - atr_0
+            resist  = close_1 + atr_0
+            xLevel  = xLevel_1
+        else:
+            if xSide == 1:
+                xLevel = resist_1
+                xSide  = 0
+            elif xSide == -1:
+                xLevel = support_1
+                xSide  = 0
+            else:
+                xLevel = xLevel_1
+            xLevels[i] = xLevel
+
+            lower = close_1 - atr_0
+            upper = close_1 + atr_0
+            if side == 1:
+                support = lower if lower > support_1 else support_1
+                resist  = upper
+            elif side == -1:
+                support = lower
+                resist  = upper if upper < resist_1 else resist_1
+            else:
+                support = lower if lower > support_1 else support_1
+                resist  = upper if upper < resist_1 else resist_1
+
+        if close_1 < resist < close_0:
+            side, xSide, breakOut = 1, 1, 1
+        elif close_1 > support > close_0:
+            side, xSide, breakOut = -1, -1, 2
+        elif close_1 < xLevel < close_0:
+            side, breakOut = 1, 3
+        elif close_1 > xLevel > close_0:
+            side, breakOut = -1, 4
+        else:
+            xSide, breakOut = 0, 0
+
+        if (breakOut == 1) or (breakOut == 3):
+            actions[i] = 1
+        elif (breakOut == 2) or (breakOut == 4):
+            actions[i] = -1
+
+        supports[i] = support_1 = support
+        resists[i]  = resist_1  = resist
+        xLevel_1    = xLevel
+
+    return supports, resists, xLevels, actions, side, xSide, breakOut
+
+
 class SingleContractAndBarDataStrategy(object):
 
     @Logger('main', 'info')
@@ -19,6 +101,8 @@ class SingleContractAndBarDataStrategy(object):
         self.actions             = None
         self.tag                 = ''
         self.lastDateStamp       = None
+        self.cursor              = None     # Sequence number of the last bar processed in barData.store.
+        self.cursorStore         = None     # Store the cursor counts in, a reload starts a new one.
         self.signals             = list()
         self.archives            = list()
         self.signalCount         = 0
@@ -59,16 +143,23 @@ class SingleContractAndBarDataStrategy(object):
 
     @Logger('main', 'info')
     def get(self, attrs=None):
-        para = {
-            'date': self.df['date'],
-            'close': self.df['close']
+        # State is kept for the latest bars only, so everything is aligned on the tail of the df.
+        attrs = [attr for attr in attrs if attr not in ['date', 'close']] if attrs is not None else list()
+        n     = min([len(self.df)] + [len(getattr(self, attr)) for attr in attrs])
+        para  = {
+            'date': self.df['date'].iloc[len(self.df) - n:].to_numpy(),
+            'close': self.df['close'].iloc[len(self.df) - n:].to_numpy()
         }
-        if attrs is not None:
-            for attr in attrs:
-                if attr not in ['date', 'close']:
-                    para[attr] = getattr(self, attr)
+        for attr in attrs:
+            para[attr] = list(getattr(self, attr))[len(getattr(self, attr)) - n:]
         return pd.DataFrame(para)
 
+    @classmethod
+    @Logger('main', 'debug')
+    def getActionsNp(cls, config, close, high, low):
+        # Actions over a whole bar history as ACTION_CODES, the array form used by the vectorized backtest.
+        pass
+
     @Logger('main', 'info')
     def plot(self, attrs=None):
         df = self.get(attrs)
@@ -105,12 +196,31 @@ class SingleContractAndBarDataStrategy(object):
     @Logger('main', 'debug')
     def updateLastDateStamp(self):
         self.lastDateStamp = self.barData.lastDateDf
+        self.cursor        = self.barData.store.tail - 1
+        self.cursorStore   = self.barData.store
+
+    # @Logger('main', 'debug')
+    def getLastIdx(self):
+        # Row of the last processed bar from the cursor in O(1), trims do not move it and leave it negative. Only
+        # when the bars were rewritten under the cursor, e.g. by a backfill merged before it, or reloaded into a new
+        # store, it is found again by date.
+        store  = self.barData.store
+        dateNs = self.lastDateStamp.value
+        if (store is not self.cursorStore) or ((self.cursor >= store.head) and (store.getDateNs(self.cursor) != dateNs)):
+            seq = store.getSeq(dateNs)
+            if store.getDateNs(seq) != dateNs:
+                raise ValueError('ATRTrailing:getLastIdx: Last processed bar no longer in the bar data.')
+            self.cursor      = seq
+            self.cursorStore = store
+        return store.getPosition(self.cursor)
 
     # @Logger('main', 'debug')
     def updateSignal(self, idx=None):
         date_0 = self.barData.lastDateDf if idx is None else self.df['date'].iloc[idx]
-        action = self.actions[-1]
+        self.createSignal(self.actions[-1], date_0)
 
+    # @Logger('main', 'debug')
+    def createSignal(self, action, date_0):
         if action is not None:
             self.signalCount += 1
             signalId = self.strategyId + '_' + str(date_0.timestamp()) + '_' + str(self.signalCount)
@@ -145,7 +255,7 @@ class ATRTrailing(SingleContractAndBarDataStrategy):
     def __init__(self, agent):
         super(ATRTrailing, self).__init__(agent)
 
-        self.trs           = [np.nan, np.nan]
+        self.atrIndicator  = None   # Unscaled ATR shared through the IndicatorManager.
         self.atrs          = None
         self.supports      = None
         self.resists       = None
@@ -156,6 +266,7 @@ class ATRTrailing(SingleContractAndBarDataStrategy):
         self.window        = None
         self.multiplier    = None
         self.rangeType     = None
+        self.historyLen    = None   # Bars of atrs and levels kept for get and plot.
 
     # ------------------------------------- Basic Functions -------------------------------------
 
@@ -178,22 +289,17 @@ class ATRTrailing(SingleContractAndBarDataStrategy):
     @Logger('main', 'debug')
     def trueRangeNp(close, high, low, rangeType=None):
         # Calculate true range array.
-        close_1 = close[:-1]
-        high_0  = high[1:]
-        low_0   = low[1:]
+        return trueRangeNp(close, high, low, rangeType=rangeType)
 
-        if rangeType is None:
-            return np.maximum.reduce([high_0 - low_0,
-                                      np.abs(high_0 - close_1),
-                                      np.abs(low_0 - close_1)])
-
-        if rangeType == 'full':
-            high_1 = high[:-1]
-            low_1  = low[:-1]
-            return np.maximum.reduce([high_0 - low_0,
-                                      high_1 - low_1,
-                                      np.abs(high_0 - low_1),
-                                      np.abs(high_1 - low_0)])
+    @classmethod
+    @Logger('main', 'debug')
+    def getActionsNp(cls, config, close, high, low):
+        # Same levels as initializeStrategy over the whole history, with no state carried in.
+        tr    = cls.trueRangeNp(close[:-1], high[:-1], low[:-1], rangeType=config['RANGE_TYPE'])
+        trs   = np.append([np.nan, np.nan], tr)
+        atrs  = (pd.Series(trs).rolling(window=config['WINDOW']).mean() * config['MULTIPLIER']).to_numpy()
+        start = int(np.argmin(np.isnan(atrs)))
+        return atrTrailingKernel(close, atrs, start, 0, 0)[3]
 
     # ------------------------------------- Initialize -------------------------------------
 
@@ -223,38 +329,35 @@ class ATRTrailing(SingleContractAndBarDataStrategy):
         self.signalValidLatency  = config['SIGNAL_VALID_LATENCY']
         self.signalValidSurvival = config['SIGNAL_VALID_SURVIVAL']
         self.sendInitialSignal   = config['SEND_INITIAL_SIGNAL']
+        self.historyLen          = max(config['HISTORY_LEN'], 1)
 
     @Logger('main', 'debug')
     def initializeStrategy(self):
-        self.supports = [np.nan] * (self.window + 1)
-        self.resists  = [np.nan] * (self.window + 1)
-        self.xLevels  = [np.nan] * (self.window + 2)
-        self.actions  = [None  ] * (self.window + 1)
-        
         assert len(self.df) > (self.window + 2)
 
-        high      = self.df['high' ].iloc[:-1].to_numpy()
-        low       = self.df['low'  ].iloc[:-1].to_numpy()
-        close     = self.df['close'].iloc[:-1].to_numpy()
-        tr        = self.trueRangeNp(close, high, low, rangeType=self.rangeType)
-        self.trs  = np.append(self.trs, tr).tolist()
-        self.atrs = (pd.Series(self.trs).rolling(window=self.window).mean() * self.multiplier).to_list()
-
-        start = np.argmin(np.isnan(self.atrs))
-        for i in range(start, len(self.atrs)):
-
-            close_1 = self.df['close'].iloc[i - 1]
-            atr_0   = self.atrs[i]
-
-            if i == start:
-                self.supports.append(close_1 - atr_0)
-                self.resists.append(close_1 + atr_0)
-            else:
-                self.updateLevel(i)
-
-            self.updateBreakout(i)
-            self.updateAction()
-            self.updateSignal(i)
+        # Strategies on the same bars and window read one ATR, only the multiplier is applied here.
+        self.atrIndicator = self.agent.IndicatorManager.subscribe(self.strategyId, self.marketDataId, 'atr',
+                                                                  window=self.window, rangeType=self.rangeType)
+        atrs = self.atrIndicator.getArray() * self.multiplier
+
+        # One compiled pass over the history, the bounded buffers continue from its results in the per-bar updates.
+        start = int(np.argmin(np.isnan(atrs)))
+        close = self.df['close'].to_numpy(dtype=float)
+        supports, resists, xLevels, actions, side, xSide, breakOut = \
+            atrTrailingKernel(close, atrs, start, SIDE_CODES[self.side], SIDE_CODES[self.xSide])
+
+        self.atrs     = deque(atrs[-self.historyLen:].tolist(), maxlen=self.historyLen)
+        self.supports = deque(supports[-self.historyLen:].tolist(), maxlen=self.historyLen)
+        self.resists  = deque(resists[-self.historyLen:].tolist(), maxlen=self.historyLen)
+        self.xLevels  = deque(xLevels[-self.historyLen:].tolist(), maxlen=self.historyLen)
+        self.actions  = deque([ACTION_NAMES[code] for code in actions[-self.historyLen:].tolist()], maxlen=self.historyLen)
+        self.side         = SIDE_NAMES[side]
+        self.xSide        = SIDE_NAMES[xSide]
+        self.breakOutType = BREAKOUT_NAMES[breakOut]
+
+        dates = self.df['date']
+        for i in np.flatnonzero(actions):
+            self.createSignal(ACTION_NAMES[int(actions[i])], dates.iloc[i])
 
     # ------------------------------------- Update -------------------------------------
 
@@ -278,10 +381,14 @@ class ATRTrailing(SingleContractAndBarDataStrategy):
 
     @Logger('main', 'debug')
     def runStrategy(self):
-        lastIdx = np.flatnonzero(self.df['date'] == self.lastDateStamp)[0]
+        lastIdx = self.getLastIdx()
+
+        # If the last processed bar is no longer stored.
+        if lastIdx < 0:
+            raise ValueError('ATRTrailing:update_all: Last processed bar trimmed off the bar data.')
 
         # If only one data point is updated in barData df.
-        if (lastIdx + 1) == (len(self.df) - 1):
+        elif (lastIdx + 1) == (len(self.df) - 1):
             self.runStrategyUpdates()
 
         # If more than one data point updated in barData df.
@@ -305,20 +412,14 @@ class ATRTrailing(SingleContractAndBarDataStrategy):
 
     # @Logger('main', 'debug')
     def updateAtr(self, idx=None):
-        close_2 = self.df['close'].iloc[-3] if idx is None else self.df['close'].iloc[idx - 2]
-        high_1  = self.df['high' ].iloc[-2] if idx is None else self.df['high' ].iloc[idx - 1]
-        low_1   = self.df['low'  ].iloc[-2] if idx is None else self.df['low'  ].iloc[idx - 1]
-        high_2  = self.df['high' ].iloc[-3] if idx is None else self.df['high' ].iloc[idx - 2]
-        low_2   = self.df['low'  ].iloc[-3] if idx is None else self.df['low'  ].iloc[idx - 2]
-
-        tr_0 = self.trueRange(close_2, high_1, low_1, high_2, low_2, rangeType=self.rangeType)
-        self.trs.append(tr_0)
-        self.atrs.append(np.mean(self.trs[-self.window:]) * self.multiplier)
+        atrs  = self.atrIndicator.getArray()
+        atr_0 = float(atrs[-1] if idx is None else atrs[idx]) * self.multiplier
+        self.atrs.append(atr_0)
 
     # @Logger('main', 'debug')
     def updateLevel(self, idx=None):
         close_1 = self.df['close'].iloc[-2] if idx is None else self.df['close'].iloc[idx - 1]
-        atr_0   = self.atrs[-1] if idx is None else self.atrs[idx]
+        atr_0   = self.atrs[-1]
 
         # Update xLevels
         if self.xSide == 'up':
@@ -396,6 +497,16 @@ class ATRTrailing(SingleContractAndBarDataStrategy):
                          f'xSide:{self.xSide} - '
                          f'breakOutType:{self.breakOutType}')
 
+    # ------------------------------------- Drop -------------------------------------
+
+    @Logger('main', 'info')
+    def drop(self):
+        # Release the shared ATR, the last strategy reading it evicts it. The next update initializes again.
+        if self.atrIndicator is not None:
+            self.agent.IndicatorManager.unsubscribe(self.strategyId, self.atrIndicator)
+            self.atrIndicator = None
+        self.isInitialized = False
+
 
 if __name__ == '__main__':
 
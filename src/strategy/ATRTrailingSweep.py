@@ -0,0 +1,67 @@
+import itertools
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from src.manager.Backtest import fillActions, summarizePnls
+from src.strategy.ATRTrailing import ATRTrailing, atrTrailingKernel
+from src.util.log_util import *
+
+
+def sweepWindow(open_, close, high, low, rangeType, window, multipliers, quantity, commission):
+    # One ATR for the window, every multiplier only rescales it before the compiled replay.
+    tr    = ATRTrailing.trueRangeNp(close[:-1], high[:-1], low[:-1], rangeType=rangeType)
+    trs   = np.append([np.nan, np.nan], tr)
+    atr   = pd.Series(trs).rolling(window=window).mean().to_numpy()
+    start = int(np.argmin(np.isnan(atr)))
+
+    rows = list()
+    for multiplier in multipliers:
+        _, _, _, actions, _, _, _ = atrTrailingKernel(close, atr * multiplier, start, 0, 0)
+        held, costs, pnls = fillActions(actions, open_, close, quantity, commission)
+        row = {'window'    : window,
+               'multiplier': multiplier,
+               'range_type': rangeType,
+               'buys'      : int(np.count_nonzero(actions > 0)),
+               'sells'     : int(np.count_nonzero(actions < 0))}
+        row.update(summarizePnls(actions, held, costs, pnls))
+        rows.append(row)
+    return rows
+
+
+class ATRTrailingSweep(object):
+
+    # Evaluate a WINDOW x MULTIPLIER x RANGE_TYPE grid of ATRTrailing over one bar history. Grid points sharing a
+    # window and range type share their true ranges and ATR, large grids are spread over a process pool. Fills and
+    # P&L follow VectorizedBacktest.
+
+    @Logger('main', 'info')
+    def __init__(self, quantity=1, commission=0., maxWorkers=None, minTasksForPool=4):
+        self.quantity        = quantity
+        self.commission      = commission     # Fraction of traded notional.
+        self.maxWorkers      = maxWorkers
+        self.minTasksForPool = minTasksForPool
+
+    @Logger('main', 'info')
+    def run(self, df, windows, multipliers, rangeTypes=(None, 'full')):
+        close = df['close'].to_numpy(dtype=float)
+        high  = df['high' ].to_numpy(dtype=float)
+        low   = df['low'  ].to_numpy(dtype=float)
+        open_ = df['open' ].to_numpy(dtype=float) if 'open' in df.columns else np.r_[close[:1], close[:-1]]
+        tasks = [(open_, close, high, low, rangeType, window, list(multipliers), self.quantity, self.commission)
+                 for rangeType, window in itertools.product(rangeTypes, windows)
+                 if len(close) > window + 2]
+
+        if (len(tasks) >= self.minTasksForPool) and (self.maxWorkers != 1):
+            with ProcessPoolExecutor(max_workers=self.maxWorkers) as executor:
+                results = list(executor.map(sweepWindow, *zip(*tasks)))
+        else:
+            results = [sweepWindow(*task) for task in tasks]
+
+        mainLogger.debug(f'Evaluated {len(tasks) * len(multipliers)} ATRTrailing parameter sets over {len(close)} bars')
+
+        return pd.DataFrame([row for rows in results for row in rows])
+
+
+if __name__ == '__main__':
+
+    pass
@@ -0,0 +1,331 @@
+import pandas as pd
+import numpy as np
+from src.strategy.ATRTrailing import ATRTrailing, atrTrailingKernel, ACTION_NAMES
+from src.util.dt_util import isWithinPeriod
+from src.util.log_util import *
+
+
+class ATRTrailingUniverse(object):
+
+    # ATRTrailing over a list of contracts in one object. State is held in arrays indexed by instrument, and each
+    # new panel row steps every instrument with a bar on it at once, giving the same levels as one ATRTrailing per
+    # contract. The signals of an update are sent to the SignalManager in one batch.
+
+    @Logger('main', 'info')
+    def __init__(self, agent):
+        self.agent               = agent
+        self.config              = None
+        self.strategyId          = ''
+        self.contractIds         = None
+        self.marketDataIds       = None
+        self.contracts           = None
+        self.tag                 = ''
+        self.window              = None
+        self.multiplier          = None
+        self.rangeType           = None
+        self.signalValidLatency  = ''
+        self.signalValidSurvival = ''
+        self.sendInitialSignal   = False
+        self.panel               = None     # Panel of the MarketDataManager, shared with other readers.
+        self.cols                = None     # Panel column of each instrument.
+        self.lastNs              = None     # Date of the last bar stepped per instrument.
+        self.isInitialized       = None     # Per instrument, False until enough bars arrived.
+        self.isReady             = None     # Per instrument, bar data active, updated and ready.
+        self.bars                = None     # bars[field, lag, instrument] of high, low, close, lag 0 is the last bar.
+        self.trs                 = None     # trs[slot, instrument], the last window true ranges.
+        self.trPos               = None     # Slot of the oldest true range.
+        self.trSum               = None
+        self.trNans              = None
+        self.trCount             = None
+        self.atrs                = None
+        self.supports            = None
+        self.resists             = None
+        self.xLevels             = None
+        self.sides               = None
+        self.xSides              = None
+        self.breakOuts           = None
+        self.actions             = None
+        self.signals             = list()
+        self.signalIdx           = list()   # Instrument of each pending signal.
+        self.archives            = list()
+        self.signalCount         = 0
+
+    # ------------------------------------- Basic Functions -------------------------------------
+
+    @Logger('main', 'debug')
+    def processSignals(self, isInitializing=False):
+        # Signals of instruments whose bar data is not ready wait for a later update, as in ATRTrailing.
+        valid, processed, pending = list(), list(), list()
+        for signal, j in zip(self.signals, self.signalIdx):
+            if not self.isReady[j]:
+                pending.append((signal, j))
+                continue
+
+            if (isInitializing is True) and (self.sendInitialSignal is False):
+                signal['is_valid'] = False
+            else:
+                signal['create_date'] = self.agent.currentTime
+                signal['is_valid'   ] = self.validateSignal(signal, j)
+
+            if signal['is_valid'] is True:
+                valid.append(signal)
+            processed.append(signal)
+
+        if len(valid) > 0:
+            self.agent.SignalManager.add(valid)
+        self.archives.extend(processed)
+        self.signals   = [signal for signal, _ in pending]
+        self.signalIdx = [j for _, j in pending]
+
+    @Logger('main', 'debug')
+    def validateSignal(self, signal, j):
+        lastDateBars    = self.agent.MarketDataManager.barDataDict[self.marketDataIds[j]].lastDateBars
+        isValidLatency  = isWithinPeriod(signal['create_date'], lastDateBars, self.signalValidLatency)
+        isValidSurvival = isWithinPeriod(lastDateBars, signal['create_date'], self.signalValidSurvival)
+        return isValidLatency or isValidSurvival
+
+    # @Logger('main', 'debug')
+    def createSignal(self, j, action, date_0):
+        self.signalCount += 1
+        signalId = self.strategyId + '_' + self.contractIds[j] + '_' + str(date_0.timestamp()) + '_' + str(self.signalCount)
+        signal   = self.agent.SignalManager.createSignal(id_=signalId,
+                                                         contract=self.contracts[j],
+                                                         action=action,
+                                                         signalDate=date_0,
+                                                         createDate=None,
+                                                         tag=self.tag,
+                                                         isValid=None)
+        self.signals.append(signal)
+        self.signalIdx.append(j)
+
+    @Logger('main', 'info')
+    def getDf(self):
+        return pd.DataFrame({'contract_id': self.contractIds,
+                             'atr'        : self.atrs,
+                             'support'    : self.supports,
+                             'resist'     : self.resists,
+                             'x_level'    : self.xLevels,
+                             'side'       : self.sides,
+                             'action'     : [ACTION_NAMES[code] for code in self.actions.tolist()]})
+
+    def toTimestamp(self, dateNs):
+        date = pd.Timestamp(int(dateNs))
+        return date.tz_localize('UTC').tz_convert(self.panel.tz) if self.panel.tz is not None else date
+
+    # ------------------------------------- Initialize -------------------------------------
+
+    @Logger('main', 'info')
+    def initialize(self, config):
+        self.initializeConfig(config)
+        self.initializeMarketData()
+        self.initializeState()
+        self.updateStrategyReadyStatus()
+        self.initializeInstruments()
+        self.processSignals(isInitializing=True)
+
+    @Logger('main', 'debug')
+    def initializeConfig(self, config):
+        self.config              = config
+        self.strategyId          = config['STRATEGY_ID']
+        self.contractIds         = list(config['CONTRACT_IDS'])
+        self.marketDataIds       = list(config['MARKET_DATA_IDS'])
+        self.tag                 = config['TAG']
+        self.window              = config['WINDOW']
+        self.multiplier          = config['MULTIPLIER']
+        self.rangeType           = config['RANGE_TYPE']
+        self.signalValidLatency  = config['SIGNAL_VALID_LATENCY']
+        self.signalValidSurvival = config['SIGNAL_VALID_SURVIVAL']
+        self.sendInitialSignal   = config['SEND_INITIAL_SIGNAL']
+
+    @Logger('main', 'debug')
+    def initializeMarketData(self):
+        marketDataManager = self.agent.MarketDataManager
+        self.contracts    = [self.agent.ContractManager.getContract(id_) for id_ in self.contractIds]
+        self.cols         = marketDataManager.requirePanelData(self.marketDataIds, ['high', 'low', 'close'],
+                                                               self.config['PANEL_MAX_LEN'])
+        self.panel        = marketDataManager.panelData
+
+    @Logger('main', 'debug')
+    def initializeState(self):
+        n = len(self.marketDataIds)
+        self.lastNs        = np.full(n, np.iinfo(np.int64).min, dtype=np.int64)
+        self.isInitialized = np.zeros(n, dtype=bool)
+        self.isReady       = np.zeros(n, dtype=bool)
+        self.bars          = np.full((3, 2, n), np.nan)
+        self.trs           = np.full((self.window, n), np.nan)
+        self.trPos         = np.zeros(n, dtype=np.int64)
+        self.trSum         = np.zeros(n)
+        self.trNans        = np.full(n, self.window, dtype=np.int64)
+        self.trCount       = np.zeros(n, dtype=np.int64)
+        self.atrs          = np.full(n, np.nan)
+        self.supports      = np.full(n, np.nan)
+        self.resists       = np.full(n, np.nan)
+        self.xLevels       = np.full(n, np.nan)
+        self.sides         = np.zeros(n, dtype=np.int8)
+        self.xSides        = np.zeros(n, dtype=np.int8)
+        self.breakOuts     = np.zeros(n, dtype=np.int8)
+        self.actions       = np.zeros(n, dtype=np.int8)
+
+    @Logger('main', 'debug')
+    def initializeInstruments(self):
+        # Instruments with enough bars replay their history in the compiled kernel, like ATRTrailing.initializeStrategy.
+        dates = self.panel.getDates()
+        mask  = self.panel.getMask()
+        for j in np.flatnonzero(~self.isInitialized):
+            col  = self.cols[j]
+            rows = np.flatnonzero(mask[:, col])
+            if len(rows) <= self.window + 2:
+                continue
+
+            high  = self.panel.getArray('high' )[rows, col]
+            low   = self.panel.getArray('low'  )[rows, col]
+            close = self.panel.getArray('close')[rows, col]
+            tr    = ATRTrailing.trueRangeNp(close[:-1], high[:-1], low[:-1], rangeType=self.rangeType)
+            trs   = np.append([np.nan, np.nan], tr)
+            atrs  = (pd.Series(trs).rolling(window=self.window).mean() * self.multiplier).to_numpy()
+            start = int(np.argmin(np.isnan(atrs)))
+            supports, resists, xLevels, actions, side, xSide, breakOut = atrTrailingKernel(close, atrs, start, 0, 0)
+
+            self.trs[:, j]        = trs[-self.window:]
+            self.trPos[j]         = 0
+            self.trSum[j]         = np.nansum(self.trs[:, j])
+            self.trNans[j]        = np.isnan(self.trs[:, j]).sum()
+            self.trCount[j]       = 0
+            self.bars[:, :, j]    = [high[[-1, -2]], low[[-1, -2]], close[[-1, -2]]]
+            self.atrs[j]          = atrs[-1]
+            self.supports[j]      = supports[-1]
+            self.resists[j]       = resists[-1]
+            self.xLevels[j]       = xLevels[-1]
+            self.sides[j]         = side
+            self.xSides[j]        = xSide
+            self.breakOuts[j]     = breakOut
+            self.actions[j]       = actions[-1]
+            self.lastNs[j]        = dates[rows[-1]]
+            self.isInitialized[j] = True
+
+            for i in np.flatnonzero(actions):
+                self.createSignal(j, ACTION_NAMES[int(actions[i])], self.toTimestamp(dates[rows[i]]))
+
+    # ------------------------------------- Update -------------------------------------
+
+    @Logger('main', 'info')
+    def update(self):
+        self.updateMarketData()
+        self.updateStrategyReadyStatus()
+        if not self.isInitialized.all():
+            self.initializeInstruments()
+            self.processSignals(isInitializing=True)
+        self.runStrategy()
+        self.processSignals(isInitializing=False)
+
+    @Logger('main', 'debug')
+    def updateMarketData(self):
+        # The panel is updated by the MarketDataManager, columns move when it drops a series.
+        marketDataManager = self.agent.MarketDataManager
+        self.cols         = marketDataManager.requirePanelData(self.marketDataIds, ['high', 'low', 'close'],
+                                                               self.config['PANEL_MAX_LEN'])
+        self.panel        = marketDataManager.panelData
+
+    @Logger('main', 'debug')
+    def updateStrategyReadyStatus(self):
+        marketDataManager = self.agent.MarketDataManager
+        rows              = marketDataManager.activeStatusData.getRows(self.marketDataIds)
+        self.isReady      = marketDataManager.activeStatusData.arrays['status'][rows] & \
+                            marketDataManager.updateStatusData.arrays['status'][rows] & \
+                            marketDataManager.readyStatusData.arrays['status'][rows]
+
+    @Logger('main', 'debug')
+    def runStrategy(self):
+        if not self.isInitialized.any():
+            return
+        dates = self.panel.getDates()
+        mask  = self.panel.getMask()
+        for r in range(int(np.searchsorted(dates, self.lastNs[self.isInitialized].min(), side='right')), len(dates)):
+            idx = np.flatnonzero(mask[r, self.cols] & self.isInitialized & (self.lastNs < dates[r]))
+            if len(idx) > 0:
+                self.runStrategyUpdates(r, idx, dates[r])
+
+    # @Logger('main', 'debug')
+    def runStrategyUpdates(self, r, idx, dateNs):
+        cols    = self.cols[idx]
+        high_0  = self.panel.getArray('high' )[r, cols]
+        low_0   = self.panel.getArray('low'  )[r, cols]
+        close_0 = self.panel.getArray('close')[r, cols]
+
+        self.updateAtr(idx)
+        self.updateLevel(idx)
+        self.updateBreakout(idx, close_0)
+
+        self.bars[:, 1, idx] = self.bars[:, 0, idx]
+        self.bars[:, 0, idx] = [high_0, low_0, close_0]
+        self.lastNs[idx]     = dateNs
+
+        date_0 = self.toTimestamp(dateNs)
+        for j in idx[self.actions[idx] != 0]:
+            self.createSignal(j, ACTION_NAMES[int(self.actions[j])], date_0)
+
+    # @Logger('main', 'debug')
+    def updateAtr(self, idx):
+        high_1, low_1, close_1 = self.bars[:, 0, idx]
+        high_2, low_2, close_2 = self.bars[:, 1, idx]
+        if self.rangeType is None:
+            tr_0 = np.maximum.reduce([high_1 - low_1, np.abs(high_1 - close_2), np.abs(low_1 - close_2)])
+        else:
+            tr_0 = np.maximum.reduce([high_1 - low_1, high_2 - low_2, np.abs(high_1 - low_2), np.abs(high_2 - low_1)])
+
+        # Running sums over the window as in the Atr indicator, unfilled slots count as NaN.
+        pos    = self.trPos[idx]
+        tr_old = self.trs[pos, idx]
+        self.trNans[idx] -= np.isnan(tr_old)
+        self.trSum[idx]  -= np.nan_to_num(tr_old)
+        self.trs[pos, idx] = tr_0
+        self.trNans[idx] += np.isnan(tr_0)
+        self.trSum[idx]  += np.nan_to_num(tr_0)
+        self.trPos[idx]   = (pos + 1) % self.window
+
+        self.trCount[idx] += 1
+        reset = idx[self.trCount[idx] % self.window == 0]
+        if len(reset) > 0:
+            self.trSum[reset]  = np.nansum(self.trs[:, reset], axis=0)
+            self.trNans[reset] = np.isnan(self.trs[:, reset]).sum(axis=0)
+
+        self.atrs[idx] = np.where(self.trNans[idx] == 0, self.trSum[idx] / self.window * self.multiplier, np.nan)
+
+    # @Logger('main', 'debug')
+    def updateLevel(self, idx):
+        close_1 = self.bars[2, 0, idx]
+        atr_0   = self.atrs[idx]
+        side    = self.sides[idx]
+        xSide   = self.xSides[idx]
+
+        # Update xLevels, a pending crossing side is consumed.
+        self.xLevels[idx] = np.where(xSide == 1, self.resists[idx], np.where(xSide == -1, self.supports[idx], self.xLevels[idx]))
+        self.xSides[idx]  = 0
+
+        # Update support and resist, comparisons keep the previous level on NaN as max and min do.
+        lower = close_1 - atr_0
+        upper = close_1 + atr_0
+        self.supports[idx] = np.where(side == -1, lower, np.where(lower > self.supports[idx], lower, self.supports[idx]))
+        self.resists[idx]  = np.where(side == 1, upper, np.where(upper < self.resists[idx], upper, self.resists[idx]))
+
+    # @Logger('main', 'debug')
+    def updateBreakout(self, idx, close_0):
+        close_1 = self.bars[2, 0, idx]
+        resist  = self.resists[idx]
+        support = self.supports[idx]
+        xLevel  = self.xLevels[idx]
+
+        isResist  = (close_1 < resist) & (resist < close_0)
+        isSupport = ~isResist & (close_1 > support) & (support > close_0)
+        isXUp     = ~isResist & ~isSupport & (close_1 < xLevel) & (xLevel < close_0)
+        isXDown   = ~isResist & ~isSupport & ~isXUp & (close_1 > xLevel) & (xLevel > close_0)
+
+        self.sides[idx]     = np.where(isResist | isXUp, 1, np.where(isSupport | isXDown, -1, self.sides[idx]))
+        self.xSides[idx]    = np.where(isResist, 1, np.where(isSupport, -1, 0))
+        self.breakOuts[idx] = np.select([isResist, isSupport, isXUp, isXDown], [1, 2, 3, 4], 0)
+        self.actions[idx]   = np.where(isResist | isXUp, 1, np.where(isSupport | isXDown, -1, 0))
+
+
+if __name__ == '__main__':
+
+    pass
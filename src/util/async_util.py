@@ -9,6 +9,17 @@ async def create_tasks(loop, paras, func):
     return tasks
 
 
+async def gather_with_limit(coros, limit):
+    # Gather coroutines with at most limit of them running at a time, results keep the input order.
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*[run(coro) for coro in coros])
+
+
 def create_loop():
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)